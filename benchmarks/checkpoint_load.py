@@ -0,0 +1,84 @@
+"""
+Startup time and peak RSS of creating a test model from a snapshot
+
+"previous" is how test_attacked.py used to create the model: VGG weights loaded into both the
+discarded FewShotSeg encoder and the FewShotSegOde encoder, then the whole snapshot read with
+torch.load into the DataParallel wrapper. "load_snapshot" skips the VGG initialisation and reads
+the snapshot with load_checkpoint, memory-mapped where the installed torch supports it. Every
+path runs in a fresh process, so the RSS is its own. Random weights in torchvision's vgg16 and
+train.py's layout are written to --workdir first.
+
+    python -m benchmarks.checkpoint_load
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+from models.checkpoint import VGG16_CONVS, load_snapshot
+
+
+def peak_rss_mb():
+    # ru_maxrss carries over the peak of the parent process through fork and exec, VmHWM does not
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 2 ** 10
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def write_checkpoints(workdir):
+    from models.ode import FewShotSegOde
+    vgg, in_channels = OrderedDict(), 3
+    for conv, out_channels in zip(VGG16_CONVS, [64] * 2 + [128] * 2 + [256] * 3 + [512] * 6):
+        vgg[f"features.{conv}.weight"] = torch.randn(out_channels, in_channels, 3, 3)
+        vgg[f"features.{conv}.bias"] = torch.randn(out_channels)
+        in_channels = out_channels
+    vgg["classifier.0.weight"] = torch.randn(4096, 512 * 7 * 7)
+    torch.save(vgg, os.path.join(workdir, "vgg16.pth"))
+    torch.save(nn.DataParallel(FewShotSegOde()).state_dict(), os.path.join(workdir, "snapshot.pth"))
+
+
+def create(method, workdir):
+    tic = time.perf_counter()
+    from models.ode import FewShotSegOde
+    vgg, snapshot = os.path.join(workdir, "vgg16.pth"), os.path.join(workdir, "snapshot.pth")
+    if method == "previous":
+        # two full reads of the VGG file, one per Encoder built
+        for _ in range(2):
+            torch.load(vgg, map_location="cpu")
+        model = nn.DataParallel(FewShotSegOde())
+        model.load_state_dict(torch.load(snapshot, map_location="cpu"))
+    else:
+        model = FewShotSegOde()
+        load_snapshot(model, snapshot)
+    seconds = time.perf_counter() - tic
+    rss = peak_rss_mb()
+    print(f"{method:>14} {seconds:9.2f} {rss:12.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workdir", default=None)
+    parser.add_argument("--method", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.method is not None:
+        create(args.method, args.workdir)
+        return
+    workdir = args.workdir or tempfile.mkdtemp()
+    write_checkpoints(workdir)
+    print(f"{'model':>14} {'seconds':>9} {'peak RSS MB':>12}")
+    for method in ["previous", "load_snapshot"]:
+        subprocess.run([sys.executable, "-m", "benchmarks.checkpoint_load", "--workdir", workdir, "--method", method], check=True)
+
+
+if __name__ == "__main__":
+    main()
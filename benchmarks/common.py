@@ -0,0 +1,69 @@
+"""
+Shared helpers for the benchmark scripts
+
+Run the benchmarks from the repository root as modules, e.g.
+    python -m benchmarks.ode_backprop_memory
+"""
+import resource
+
+import torch
+
+
+def get_device(name):
+    if name == "cuda" and not torch.cuda.is_available():
+        print("CUDA not available, falling back to CPU")
+        name = "cpu"
+    return torch.device(name)
+
+
+def synthetic_episode(batch_size, n_shot=1, size=256, device="cpu", fg_ratio=0.3):
+    """
+    Random episode batch shaped like the squeezed BCV samples in train.py
+
+    Returns:
+        s_x: B x Support x 1 x H x W
+        s_y: B x Support x H x W, binary foreground masks
+        q_x: B x 1 x H x W
+        q_y: B x H x W, long labels
+    """
+    s_x = torch.randn(batch_size, n_shot, 1, size, size, device=device)
+    s_y = (torch.rand(batch_size, n_shot, size, size, device=device) < fg_ratio).float()
+    q_x = torch.randn(batch_size, 1, size, size, device=device)
+    q_y = (torch.rand(batch_size, size, size, device=device) < fg_ratio).long()
+    return s_x, s_y, q_x, q_y
+
+
+def episode_inputs(s_x, s_y, q_x):
+    """Split stacked tensors into the way x shot lists taken by FewShotSeg.forward"""
+    n_shot = s_x.shape[1]
+    s_xs = [[s_x[:, shot, ...] for shot in range(n_shot)]]
+    s_y_fgs = [[s_y[:, shot, ...] for shot in range(n_shot)]]
+    s_y_bgs = [[1 - s_y[:, shot, ...] for shot in range(n_shot)]]
+    return s_xs, s_y_fgs, s_y_bgs, [q_x]
+
+
+def reset_peak_memory(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory_mb(device):
+    """Peak allocated CUDA memory, or peak RSS of the whole process on CPU"""
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    # ru_maxrss carries over the peak of the parent process through fork and exec, VmHWM does not
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
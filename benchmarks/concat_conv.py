@@ -0,0 +1,75 @@
+"""
+Time and allocations per ODE evaluation of ODEfunc with ConcatConv2d against FusedConcatConv2d
+
+Both functions share the same weights (the fused one loads the ConcatConv2d state dict), so the
+script also reports the largest difference between their outputs.
+
+    python -m benchmarks.concat_conv --batch_size 2 --size 64
+"""
+import argparse
+import time
+
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+from models.ode import ODEfunc
+from benchmarks.common import get_device, synchronize
+
+
+def time_per_eval(funcs, t, x, n_iter, device):
+    """Median ms per evaluation of every function, alternating between them so that load changes hit all alike"""
+    times = {name: [] for name in funcs}
+    for name, func in funcs.items():
+        func(t, x)
+    for _ in range(n_iter):
+        for name, func in funcs.items():
+            synchronize(device)
+            tic = time.perf_counter()
+            func(t, x)
+            synchronize(device)
+            times[name].append((time.perf_counter() - tic) * 1000)
+    return {name: sorted(ms)[len(ms) // 2] for name, ms in times.items()}
+
+
+def allocated_mb(func, t, x, device):
+    """Bytes allocated by one evaluation, summed over all ops"""
+    activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if device.type == "cuda" else [])
+    with profile(activities=activities, profile_memory=True) as prof:
+        func(t, x)
+    events = prof.key_averages()
+    if device.type == "cuda":
+        total = sum(max(e.self_cuda_memory_usage, 0) for e in events)
+    else:
+        total = sum(max(e.self_cpu_memory_usage, 0) for e in events)
+    return total / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--size", type=int, default=64, help="encoder feature resolution, 64 for 256x256 inputs")
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--ode_layers", type=int, default=3)
+    parser.add_argument("--n_iter", type=int, default=20)
+    args = parser.parse_args()
+
+    device = get_device(args.device)
+    concat = ODEfunc(args.dim, n_layers=args.ode_layers, fused_time=False).to(device).eval()
+    fused = ODEfunc(args.dim, n_layers=args.ode_layers, fused_time=True).to(device).eval()
+    fused.load_state_dict(concat.state_dict())
+    x = torch.randn(args.batch_size, args.dim, args.size, args.size, device=device)
+    t = torch.tensor(1.5, device=device)
+
+    with torch.no_grad():
+        diff = (concat(t, x) - fused(t, x)).abs().max().item()
+        print(f"max abs difference: {diff:.3e}")
+        funcs = {"concat": concat, "fused": fused}
+        times = time_per_eval(funcs, t, x, args.n_iter, device)
+        print(f"{'layer':>8} {'ms / eval':>10} {'alloc MB / eval':>16}")
+        for name, func in funcs.items():
+            print(f"{name:>8} {times[name]:10.2f} {allocated_mb(func, t, x, device):16.1f}")
+
+
+if __name__ == "__main__":
+    main()
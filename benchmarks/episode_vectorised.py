@@ -0,0 +1,104 @@
+"""
+Step time of FewShotSeg.segment with the batched episode computation against the per-episode loop
+
+The loop is the previous implementation of FewShotSeg.segment, which pools, averages and scores
+every episode, way and shot separately. Both run forward and backward on the same random encoder
+features, and the script checks that they agree.
+
+    python -m benchmarks.episode_vectorised --batch_sizes 1 2 5 8 --n_shot 3
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from models.fewshot import FewShotSeg
+from benchmarks.common import get_device, synchronize, synthetic_episode, episode_inputs
+
+
+class LoopedFewShotSeg(FewShotSeg):
+    """FewShotSeg with the per-episode loop of the original segment"""
+
+    def segment(self, img_fts, supp_imgs, fore_mask, qry_imgs, return_feats=False):
+        n_ways = len(supp_imgs)
+        n_shots = len(supp_imgs[0])
+        n_queries = len(qry_imgs)
+        batch_size = supp_imgs[0][0].shape[0]
+        img_size = supp_imgs[0][0].shape[-2:]
+        fts_size = img_fts.shape[-2:]
+
+        supp_fts = img_fts[:n_ways * n_shots * batch_size].view(n_ways, n_shots, batch_size, -1, *fts_size)
+        qry_fts = img_fts[n_ways * n_shots * batch_size:].view(n_queries, batch_size, -1, *fts_size)
+        fore_mask = torch.stack([torch.stack(way, dim=0) for way in fore_mask], dim=0)
+        back_mask = torch.ones_like(fore_mask) - fore_mask
+        outputs = []
+        all_prototypes = []
+        all_fg_prototypess = []
+        for epi in range(batch_size):
+            supp_fg_fts = [[self.getFeatures(supp_fts[way, shot, [epi]], fore_mask[way, shot, [epi]])
+                            for shot in range(n_shots)] for way in range(n_ways)]
+            supp_bg_fts = [[self.getFeatures(supp_fts[way, shot, [epi]], back_mask[way, shot, [epi]])
+                            for shot in range(n_shots)] for way in range(n_ways)]
+            fg_prototypes, bg_prototype = self.getPrototype(supp_fg_fts, supp_bg_fts)
+            prototypes = [bg_prototype, ] + fg_prototypes
+            dist = [self.calDist(qry_fts[:, epi], prototype) for prototype in prototypes]
+            all_prototypes += prototypes
+            all_fg_prototypess += fg_prototypes
+            pred = torch.stack(dist, dim=1)
+            outputs.append(F.interpolate(pred, size=img_size, mode='bilinear'))
+
+        all_prototypes = torch.stack(all_prototypes, dim=0)
+        all_fg_prototypess = torch.stack(all_fg_prototypess, dim=0)
+        output = torch.stack(outputs, dim=1)
+        output = output.view(-1, *output.shape[2:])
+        if return_feats:
+            return output, all_prototypes, qry_fts
+        return output, all_fg_prototypess
+
+
+def step(model, img_fts, inputs):
+    s_xs, s_y_fgs, _, q_xs = inputs
+    img_fts.grad = None
+    output, prototypes, _ = model.segment(img_fts, s_xs, s_y_fgs, q_xs, return_feats=True)
+    (output.mean() + prototypes.mean()).backward()
+    return output, prototypes, img_fts.grad
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 2, 5, 8])
+    parser.add_argument("--n_shot", type=int, default=1)
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--fts_size", type=int, default=32)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--n_iter", type=int, default=5)
+    args = parser.parse_args()
+
+    device = get_device(args.device)
+    models = {"loop": LoopedFewShotSeg(), "batched": FewShotSeg()}
+    for model in models.values():
+        model.factor = 1
+
+    print(f"{'batch':>6} {'loop ms':>9} {'batched ms':>11} {'speedup':>8} {'max diff':>9}")
+    for batch_size in args.batch_sizes:
+        s_x, s_y, q_x, _ = synthetic_episode(batch_size, args.n_shot, args.size, device)
+        inputs = episode_inputs(s_x, s_y, q_x)
+        n_imgs = (args.n_shot + 1) * batch_size
+        img_fts = torch.randn(n_imgs, args.dim, args.fts_size, args.fts_size, device=device, requires_grad=True)
+        results, times = {}, {}
+        for name, model in models.items():
+            results[name] = step(model, img_fts, inputs)
+            synchronize(device)
+            tic = time.perf_counter()
+            for _ in range(args.n_iter):
+                step(model, img_fts, inputs)
+            synchronize(device)
+            times[name] = (time.perf_counter() - tic) / args.n_iter * 1000
+        diff = max((a - b).abs().max().item() for a, b in zip(results["loop"], results["batched"]))
+        print(f"{batch_size:6d} {times['loop']:9.1f} {times['batched']:11.1f} {times['loop'] / times['batched']:8.2f} {diff:9.2e}")
+
+
+if __name__ == "__main__":
+    main()
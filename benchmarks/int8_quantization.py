@@ -0,0 +1,76 @@
+"""
+CPU latency and agreement of the static int8 FewShotSegOde against fp32
+
+The int8 models are calibrated on --n_calib synthetic episodes and compared with the fp32 model
+they were quantised from on other episodes: "encoder" is the VGG backbone alone, "predict" the
+whole FewShotSegOde.predict with only the backbone quantised ("int8") and with the ODE dynamics
+convolutions as well ("int8 + ode"). Agreement is the dice of the int8 foreground with the fp32
+one. Random weights stand in for a snapshot; calibrate_int8.py gives the dice on BCV.
+
+    python -m benchmarks.int8_quantization --threads 4
+"""
+import argparse
+import time
+
+import torch
+
+from models.ode import FewShotSegOde
+from models.fewshot import predict_labels
+from models.quantize import quantize_int8
+from benchmarks.common import synthetic_episode
+from benchmarks.proto_pooling import dice
+
+
+def timed(fn, n_iter):
+    fn()
+    tic = time.perf_counter()
+    for _ in range(n_iter):
+        out = fn()
+    return out, (time.perf_counter() - tic) / n_iter * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--method", default="rk4")
+    parser.add_argument("--n_steps", type=int, default=4)
+    parser.add_argument("--n_calib", type=int, default=8)
+    parser.add_argument("--n_eval", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--n_iter", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    solver = {"method": args.method, "n_steps": args.n_steps}
+    models = {"fp32": FewShotSegOde(ode_time=4, ode_solver=solver).eval().prepare_inference()}
+    calib = [synthetic_episode(1, 1, args.size) for _ in range(args.n_calib)]
+    episodes = [synthetic_episode(1, 1, args.size) for _ in range(args.n_eval)]
+
+    def calibrate(model):
+        for s_x, s_y, q_x, _ in calib:
+            model.predict(s_x, s_y, q_x)
+
+    for name, ode in [("int8", False), ("int8 + ode", True)]:
+        models[name] = FewShotSegOde(ode_time=4, ode_solver=solver)
+        models[name].load_state_dict(models["fp32"].state_dict())
+        quantize_int8(models[name], calibrate, ode=ode)
+        models[name].prepare_inference()
+
+    print(f"{'model':>11} {'encoder ms':>11} {'predict ms':>11} {'max logit diff':>15} {'fg dice vs fp32':>16}")
+    reference = [models["fp32"].predict(s_x, s_y, q_x) for s_x, s_y, q_x, _ in episodes]
+    s_x, s_y, q_x, _ = episodes[0]
+    for name, model in models.items():
+        with torch.inference_mode():
+            _, encoder_ms = timed(lambda: model.encoder.backbone(q_x.repeat(2, 1, 1, 1)), args.n_iter)
+        _, predict_ms = timed(lambda: model.predict(s_x, s_y, q_x), args.n_iter)
+        logits = [model.predict(s_x, s_y, q_x) for s_x, s_y, q_x, _ in episodes]
+        diff = max((a - b).abs().max().item() for a, b in zip(logits, reference))
+        agreement = sum(dice(predict_labels(a, q_x.shape[-2:]), predict_labels(b, q_x.shape[-2:]))
+                        for a, b in zip(logits, reference)) / len(episodes)
+        print(f"{name:>11} {encoder_ms:11.1f} {predict_ms:11.1f} {diff:15.3e} {agreement:16.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Time and allocations of a training step with full resolution against feature resolution logits
+
+Both run FewShotSeg.segment and the query loss forward and backward on the same random encoder
+features. "full" upsamples the logits to the image size and takes the cross entropy against the
+labels, "low-res" keeps them at feature resolution and takes the cross entropy against area
+downsampled labels. The pred dice column compares predict_labels of the low resolution logits
+with the argmax of the upsampled ones, so 1 means identical segmentations. The prototypes are
+pooled with --pooling, 'exact' by default so that the upsampling of the support features for
+'upsample' pooling does not hide the cost of the logits.
+
+    python -m benchmarks.low_res_logits --batch_size 5 --n_shot 1
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from models.fewshot import FewShotSeg, POOLING_MODES, predict_labels, soft_labels, soft_cross_entropy
+from benchmarks.common import get_device, synchronize, synthetic_episode, episode_inputs
+from benchmarks.proto_pooling import allocated_mb, dice
+
+
+def step(model, img_fts, inputs, q_y):
+    s_xs, s_y_fgs, _, q_xs = inputs
+    img_fts.grad = None
+    logits = model.segment(img_fts, s_xs, s_y_fgs, q_xs)[0]
+    if model.low_res_logits:
+        loss = soft_cross_entropy(logits, soft_labels(q_y, logits.shape[-2:], logits.shape[1]))
+    else:
+        loss = F.cross_entropy(logits, q_y)
+    loss.backward()
+    return logits.detach()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--batch_size", type=int, default=5)
+    parser.add_argument("--n_shot", type=int, default=1)
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--fts_size", type=int, default=32)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--pooling", default="exact", choices=POOLING_MODES)
+    parser.add_argument("--n_iter", type=int, default=5)
+    args = parser.parse_args()
+
+    device = get_device(args.device)
+    s_x, s_y, q_x, q_y = synthetic_episode(args.batch_size, args.n_shot, args.size, device)
+    inputs = episode_inputs(s_x, s_y, q_x)
+    n_imgs = (args.n_shot + 1) * args.batch_size
+    img_fts = torch.randn(n_imgs, args.dim, args.fts_size, args.fts_size, device=device, requires_grad=True)
+
+    reference = None
+    print(f"{'logits':>8} {'ms / step':>10} {'alloc MB':>9} {'pred dice':>10}")
+    for name, low_res in [("full", False), ("low-res", True)]:
+        model = FewShotSeg(pooling=args.pooling, low_res_logits=low_res).to(device)
+        model.factor = 1
+        pred = predict_labels(step(model, img_fts, inputs, q_y), q_y.shape[-2:])
+        if reference is None:
+            reference = pred
+        synchronize(device)
+        tic = time.perf_counter()
+        for _ in range(args.n_iter):
+            step(model, img_fts, inputs, q_y)
+        synchronize(device)
+        ms = (time.perf_counter() - tic) / args.n_iter * 1000
+        mb = allocated_mb(lambda: step(model, img_fts, inputs, q_y), device)
+        print(f"{name:>8} {ms:10.1f} {mb:9.1f} {dice(pred, reference):10.4f}")
+
+
+if __name__ == "__main__":
+    main()
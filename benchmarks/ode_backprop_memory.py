@@ -0,0 +1,62 @@
+"""
+Peak memory and time of one FewShotSegOde training step for each ODE backprop mode
+
+Each mode runs in a fresh process so the CPU peak RSS numbers do not leak into each other.
+
+    python -m benchmarks.ode_backprop_memory --device cpu --batch_size 2 --ode_time 4
+"""
+import argparse
+import multiprocessing as mp
+import time
+
+import torch
+import torch.nn as nn
+
+from models.ode import FewShotSegOde, BACKPROP_MODES
+from benchmarks.common import get_device, synthetic_episode, episode_inputs, reset_peak_memory, \
+    peak_memory_mb, synchronize
+
+
+def run_mode(mode, args, queue):
+    torch.manual_seed(args.seed)
+    device = get_device(args.device)
+    model = FewShotSegOde(ode_layers=args.ode_layers, ode_time=args.ode_time, ode_backprop=mode).to(device)
+    model.train()
+    s_x, s_y, q_x, q_y = synthetic_episode(args.batch_size, args.n_shot, args.size, device)
+    criterion = nn.CrossEntropyLoss()
+
+    reset_peak_memory(device)
+    before = peak_memory_mb(device)
+    tic = time.perf_counter()
+    query_pred, _ = model(*episode_inputs(s_x, s_y, q_x))
+    criterion(query_pred, q_y).backward()
+    synchronize(device)
+    stats = model.encoder.ode.ode.stats
+    queue.put((mode, time.perf_counter() - tic, before, peak_memory_mb(device), stats.nfe_forward, stats.nfe_backward))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--n_shot", type=int, default=1)
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--ode_layers", type=int, default=3)
+    parser.add_argument("--ode_time", type=float, default=4)
+    parser.add_argument("--modes", nargs="+", default=list(BACKPROP_MODES))
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    print(f"{'mode':>14} {'step s':>8} {'base MB':>9} {'peak MB':>9} {'nfe fwd':>8} {'nfe bwd':>8}")
+    for mode in args.modes:
+        proc = ctx.Process(target=run_mode, args=(mode, args, queue))
+        proc.start()
+        mode, elapsed, before, peak, nfe_forward, nfe_backward = queue.get()
+        proc.join()
+        print(f"{mode:>14} {elapsed:8.2f} {before:9.1f} {peak:9.1f} {nfe_forward:8d} {nfe_backward:8d}")
+
+
+if __name__ == "__main__":
+    main()
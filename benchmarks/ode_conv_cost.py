@@ -0,0 +1,79 @@
+"""
+Cost of the ODE dynamics parameterisations selected by ode_conv
+
+For every variant the table lists the parameters, the multiply-accumulates of one ODE evaluation
+(counted over all convolutions, time kernels included), the NFE of a dopri5 solve to ode_time,
+and the latency of one evaluation and of the whole solve. Weights are random, so the NFE only
+indicates how the parameterisations compare; the dice of each variant comes from training it with
+ode_conv=<variant> and testing with test_attacked.py.
+
+    python -m benchmarks.ode_conv_cost --batch_size 2 --size 32
+"""
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+
+from models.ode import ODE_CONVS, ODEBlock, ODEfunc
+from benchmarks.common import get_device, synchronize
+from benchmarks.concat_conv import time_per_eval
+
+
+def count_macs(func, t, x):
+    """Multiply-accumulates of all convolutions in one evaluation of func"""
+    macs = []
+
+    def hook(module, inputs, output):
+        macs.append(output.numel() * module.in_channels // module.groups * module.kernel_size[0] * module.kernel_size[1])
+
+    handles = [m.register_forward_hook(hook) for m in func.modules() if isinstance(m, nn.Conv2d)]
+    func(t, x)
+    for handle in handles:
+        handle.remove()
+    # the time kernels run through F.conv2d on a single ones plane
+    for name, param in func.named_parameters():
+        if name.endswith("time_weight"):
+            macs.append(param.numel() * x.shape[-2] * x.shape[-1])
+    return sum(macs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--size", type=int, default=32, help="encoder feature resolution")
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--ode_layers", type=int, default=3)
+    parser.add_argument("--ode_time", type=float, default=4)
+    parser.add_argument("--groups", type=int, default=8)
+    parser.add_argument("--rank", type=int, default=64)
+    parser.add_argument("--n_iter", type=int, default=10)
+    args = parser.parse_args()
+
+    device = get_device(args.device)
+    x = torch.randn(args.batch_size, args.dim, args.size, args.size, device=device)
+    t = torch.tensor(1.5, device=device)
+
+    funcs = {conv: ODEfunc(args.dim, n_layers=args.ode_layers, conv=conv, groups=args.groups, rank=args.rank).to(device).eval()
+             for conv in ODE_CONVS}
+    with torch.no_grad():
+        ms_evals = time_per_eval(funcs, t, x, args.n_iter, device)
+
+    print(f"{'ode_conv':>10} {'params M':>9} {'GMAC / eval':>12} {'nfe':>5} {'ms / eval':>10} {'ms / solve':>11}")
+    for conv, func in funcs.items():
+        block = ODEBlock(func, ode_time=args.ode_time, solver={"warm_start": False}).eval()
+        params = sum(p.numel() for p in func.parameters()) / 1e6
+        with torch.no_grad():
+            gmacs = count_macs(func, t, x) / 1e9
+            ms_eval = ms_evals[conv]
+            synchronize(device)
+            tic = time.perf_counter()
+            block(x)
+            synchronize(device)
+            ms_solve = (time.perf_counter() - tic) * 1000
+        print(f"{conv:>10} {params:9.2f} {gmacs:12.2f} {block.stats.nfe_forward:5d} {ms_eval:10.2f} {ms_solve:11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Throughput and NFE of the ODE block with autocast function evaluations against fp32
+
+"test" is a no_grad eval forward as in test_attacked.py, "train" a forward and backward as in
+train.py. The difference column is the largest deviation from the fp32 features relative to the
+largest fp32 feature. ODEBlock raises a tol below the machine epsilon of the autocast dtype to it,
+so fp32 also runs at that tol to separate the cost of the looser tolerance from that of autocast.
+Use --autocast float16 on GPU.
+
+    python -m benchmarks.ode_mixed_precision --batch_size 2 --size 32
+"""
+import argparse
+import time
+
+import torch
+
+from models.ode import ODEBlock, ODEfunc
+from benchmarks.common import get_device, synchronize
+from benchmarks.per_sample_ode import mixed_features
+
+
+def timed(fn, n_iter, device):
+    fn()
+    synchronize(device)
+    tic = time.perf_counter()
+    for _ in range(n_iter):
+        out = fn()
+    synchronize(device)
+    return out, (time.perf_counter() - tic) / n_iter * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--autocast", default="bfloat16")
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--size", type=int, default=32, help="encoder feature resolution")
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--ode_time", type=float, default=4)
+    parser.add_argument("--tol", type=float, default=1e-3)
+    parser.add_argument("--n_iter", type=int, default=2)
+    args = parser.parse_args()
+
+    device = get_device(args.device)
+    odefunc = ODEfunc(args.dim).to(device)
+    x = mixed_features(args.batch_size, args.dim, args.size, device)
+    reference = {}
+
+    print(f"{'precision':>10} {'mode':>6} {'tol':>8} {'ms / forward':>13} {'nfe':>5} {'rejected':>9} {'rel diff':>9}")
+    autocast_tol = max(args.tol, torch.finfo(getattr(torch, args.autocast)).eps)
+    runs = [(None, args.tol)] + ([(None, autocast_tol)] if autocast_tol > args.tol else []) + [(args.autocast, args.tol)]
+    for precision, tol in runs:
+        solver = {"tol": tol, "autocast": precision, "warm_start": False}
+        odefunc.autocast_dtype = None
+        block = ODEBlock(odefunc, ode_time=args.ode_time, solver=solver)
+
+        def test():
+            block.eval()
+            with torch.no_grad():
+                return block(x)
+
+        def train():
+            block.train()
+            out = block(x.requires_grad_())
+            out.pow(2).mean().backward()
+            return out.detach()
+
+        for mode, fn in [("test", test), ("train", train)]:
+            out, ms = timed(fn, args.n_iter, device)
+            if mode not in reference:
+                reference[mode] = out
+            diff = ((out - reference[mode]).abs().max() / reference[mode].abs().max()).item()
+            stats = block.stats
+            print(f"{precision or 'float32':>10} {mode:>6} {block.tol:8.1e} {ms:13.1f} {stats.nfe_forward:5d} "
+                  f"{stats.rejected_steps:9d} {diff:9.2e}")
+
+
+if __name__ == "__main__":
+    main()
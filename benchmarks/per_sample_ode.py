@@ -0,0 +1,93 @@
+"""
+Throughput of per-sample adaptive ODE stepping against the joint batch solve
+
+The joint dopri5 solve steps the whole encoder batch at the size its hardest sample needs, the
+per-sample solve (ode_solver per_sample=True) lets every sample take its own steps. How much this
+saves depends on how much the samples differ, which random weights understate, so pass a trained
+snapshot with --snapshot to benchmark the learned dynamics. The batch mixes smooth, white noise
+and spiky feature maps.
+
+    python -m benchmarks.per_sample_ode --batch_size 8 --size 32 --snapshot <weights-path>
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from models.ode import ODEBlock, ODEfunc
+from models.checkpoint import load_checkpoint
+from benchmarks.common import get_device, synchronize
+
+
+def mixed_features(batch_size, dim, size, device):
+    """Feature maps of increasing roughness, cycling through smooth, white noise and spiky"""
+    feats = []
+    for i in range(batch_size):
+        if i % 3 == 0:
+            x = F.interpolate(torch.randn(1, dim, 4, 4), size=size, mode="bilinear", align_corners=False)
+        elif i % 3 == 1:
+            x = torch.randn(1, dim, size, size)
+        else:
+            x = torch.randn(1, dim, size, size)
+            x[..., ::7, ::7] *= 30
+        feats.append(x)
+    return torch.cat(feats).to(device)
+
+
+def load_odefunc(odefunc, snapshot):
+    """Copy the ODE function weights out of a FewShotSegOde (or DataParallel) snapshot"""
+    prefix = "ode.ode.odefunc."
+    state_dict = load_checkpoint(snapshot)
+    state_dict = {key.split(prefix, 1)[1]: value for key, value in state_dict.items() if prefix in key}
+    odefunc.load_state_dict(state_dict)
+
+
+def run(block, x, n_iter, device):
+    with torch.no_grad():
+        block(x)
+        synchronize(device)
+        tic = time.perf_counter()
+        for _ in range(n_iter):
+            out = block(x)
+        synchronize(device)
+    return out, (time.perf_counter() - tic) / n_iter
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--batch_size", type=int, default=6)
+    parser.add_argument("--size", type=int, default=32, help="encoder feature resolution")
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--ode_layers", type=int, default=3)
+    parser.add_argument("--ode_time", type=float, default=4)
+    parser.add_argument("--tol", type=float, default=1e-3)
+    parser.add_argument("--snapshot", default=None)
+    parser.add_argument("--n_iter", type=int, default=3)
+    args = parser.parse_args()
+
+    device = get_device(args.device)
+    odefunc = ODEfunc(args.dim, n_layers=args.ode_layers)
+    if args.snapshot is not None:
+        load_odefunc(odefunc, args.snapshot)
+    odefunc = odefunc.to(device).eval()
+    x = mixed_features(args.batch_size, args.dim, args.size, device)
+
+    outs = {}
+    print(f"{'solve':>10} {'ms / batch':>11} {'samples / s':>12} {'nfe':>5} {'sample steps':>13}")
+    for name, per_sample in [("joint", False), ("per-sample", True)]:
+        solver = {"method": "dopri5", "tol": args.tol, "per_sample": per_sample, "warm_start": False}
+        block = ODEBlock(odefunc, ode_time=args.ode_time, solver=solver).eval()
+        outs[name], seconds = run(block, x, args.n_iter, device)
+        stats = block.stats
+        # the joint solve takes every step for the whole batch
+        steps = stats.accepted_steps + stats.rejected_steps
+        steps = steps if per_sample else steps * args.batch_size
+        print(f"{name:>10} {seconds * 1000:11.1f} {args.batch_size / seconds:12.2f} {stats.nfe_forward:5d} {steps:13d}")
+    diff = (outs["joint"] - outs["per-sample"]).abs().max() / outs["joint"].abs().max()
+    print(f"max difference relative to the largest feature: {diff.item():.3e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+CPU latency per query slice of FewShotSegOde.predict against the forward used by test_attacked.py
+
+"forward" is the DataParallel wrapped forward with list inputs under no_grad, "predict" the
+inference_mode fast path on stacked tensors with a channels_last encoder backbone. Both use the
+same weights and the fixed step --method, so they take the same number of ODE evaluations.
+
+    python -m benchmarks.predict_latency --n_shot 1 --threads 4
+"""
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+
+from models.ode import FewShotSegOde
+from benchmarks.common import get_device, synchronize, synthetic_episode, episode_inputs
+
+
+def timed(fn, n_iter, device):
+    fn()
+    synchronize(device)
+    tic = time.perf_counter()
+    for _ in range(n_iter):
+        out = fn()
+    synchronize(device)
+    return out, (time.perf_counter() - tic) / n_iter * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--n_shot", type=int, default=1)
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--method", default="rk4")
+    parser.add_argument("--n_steps", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--n_iter", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = get_device(args.device)
+    solver = {"method": args.method, "n_steps": args.n_steps}
+    model = FewShotSegOde(ode_time=4, ode_solver=solver).to(device).eval()
+    fast_model = FewShotSegOde(ode_time=4, ode_solver=solver).to(device).eval()
+    fast_model.load_state_dict(model.state_dict())
+    fast_model.prepare_inference()
+    wrapped = nn.DataParallel(model)
+
+    s_x, s_y, q_x, _ = synthetic_episode(1, args.n_shot, args.size, device)
+    inputs = episode_inputs(s_x, s_y, q_x)
+
+    def forward():
+        with torch.no_grad():
+            return wrapped(*inputs)[0]
+
+    reference, forward_ms = timed(forward, args.n_iter, device)
+    logits, predict_ms = timed(lambda: fast_model.predict(s_x, s_y, q_x), args.n_iter, device)
+    diff = (logits - reference).abs().max().item()
+    print(f"{'path':>8} {'ms / slice':>11}")
+    print(f"{'forward':>8} {forward_ms:11.1f}")
+    print(f"{'predict':>8} {predict_ms:11.1f}")
+    print(f"speedup {forward_ms / predict_ms:.2f}x, max abs logit difference {diff:.3e}")
+
+
+if __name__ == "__main__":
+    main()
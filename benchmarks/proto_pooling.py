@@ -0,0 +1,80 @@
+"""
+Memory, time and prediction agreement of the prototype pooling modes of FewShotSeg
+
+Every mode runs FewShotSeg.segment forward and backward on the same random encoder features. The
+allocations are summed over all ops by the profiler. The dice column compares the query
+prediction of each mode with the one of 'upsample', so 1 means identical segmentations.
+
+    python -m benchmarks.proto_pooling --batch_size 5 --n_shot 1
+"""
+import argparse
+import time
+
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+from models.fewshot import FewShotSeg, POOLING_MODES
+from benchmarks.common import get_device, synchronize, synthetic_episode, episode_inputs
+
+
+def step(model, img_fts, inputs):
+    s_xs, s_y_fgs, _, q_xs = inputs
+    img_fts.grad = None
+    output, prototypes, _ = model.segment(img_fts, s_xs, s_y_fgs, q_xs, return_feats=True)
+    (output.mean() + prototypes.mean()).backward()
+    return output.detach(), prototypes.detach()
+
+
+def allocated_mb(fn, device):
+    activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if device.type == "cuda" else [])
+    with profile(activities=activities, profile_memory=True) as prof:
+        fn()
+    events = prof.key_averages()
+    if device.type == "cuda":
+        return sum(max(e.self_cuda_memory_usage, 0) for e in events) / 2 ** 20
+    return sum(max(e.self_cpu_memory_usage, 0) for e in events) / 2 ** 20
+
+
+def dice(a, b):
+    return (2 * (a * b).sum() / (a.sum() + b.sum()).clamp(min=1)).item()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--batch_size", type=int, default=5)
+    parser.add_argument("--n_shot", type=int, default=1)
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--fts_size", type=int, default=32)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--n_iter", type=int, default=3)
+    args = parser.parse_args()
+
+    device = get_device(args.device)
+    s_x, s_y, q_x, _ = synthetic_episode(args.batch_size, args.n_shot, args.size, device)
+    inputs = episode_inputs(s_x, s_y, q_x)
+    n_imgs = (args.n_shot + 1) * args.batch_size
+    img_fts = torch.randn(n_imgs, args.dim, args.fts_size, args.fts_size, device=device, requires_grad=True)
+
+    reference = None
+    print(f"{'pooling':>9} {'ms / step':>10} {'alloc MB':>9} {'proto diff':>11} {'pred dice':>10}")
+    for pooling in POOLING_MODES:
+        model = FewShotSeg(pooling=pooling).to(device)
+        model.factor = 1
+        output, prototypes = step(model, img_fts, inputs)
+        if reference is None:
+            reference = output, prototypes
+        synchronize(device)
+        tic = time.perf_counter()
+        for _ in range(args.n_iter):
+            step(model, img_fts, inputs)
+        synchronize(device)
+        ms = (time.perf_counter() - tic) / args.n_iter * 1000
+        mb = allocated_mb(lambda: step(model, img_fts, inputs), device)
+        diff = (prototypes - reference[1]).abs().max().item()
+        agreement = dice(output.argmax(1), reference[0].argmax(1))
+        print(f"{pooling:>9} {ms:10.1f} {mb:9.1f} {diff:11.2e} {agreement:10.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Time to score query features against all prototypes, one calDist per prototype against calDists
+
+The per-prototype loop renormalises the query features for every prototype, calDists normalises
+them once and scores all classes with a single matmul. The gap grows with the number of ways.
+
+    python -m benchmarks.prototype_scoring --batch_size 4 --ways 1 2 4 8
+"""
+import argparse
+import time
+
+import torch
+
+from models.fewshot import FewShotSeg
+from benchmarks.common import get_device, synchronize
+
+
+def looped(model, qry_fts, prototypes):
+    return torch.stack([model.calDist(qry_fts, prototype) for prototype in prototypes.unbind(dim=1)], dim=1)
+
+
+def batched(model, qry_fts, prototypes):
+    return model.calDists(qry_fts, prototypes)
+
+
+def time_ms(fn, n_iter, device):
+    with torch.no_grad():
+        fn()
+        synchronize(device)
+        tic = time.perf_counter()
+        for _ in range(n_iter):
+            fn()
+        synchronize(device)
+    return (time.perf_counter() - tic) / n_iter * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--ways", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--fts_size", type=int, default=32)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--n_iter", type=int, default=20)
+    args = parser.parse_args()
+
+    device = get_device(args.device)
+    model = FewShotSeg().to(device)
+    qry_fts = torch.randn(args.batch_size, args.dim, args.fts_size, args.fts_size, device=device)
+
+    print(f"{'ways':>5} {'looped ms':>10} {'batched ms':>11} {'speedup':>8} {'max abs diff':>13}")
+    for n_ways in args.ways:
+        prototypes = torch.randn(args.batch_size, 1 + n_ways, args.dim, device=device)
+        with torch.no_grad():
+            diff = (looped(model, qry_fts, prototypes) - batched(model, qry_fts, prototypes)).abs().max().item()
+        loop_ms = time_ms(lambda: looped(model, qry_fts, prototypes), args.n_iter, device)
+        batch_ms = time_ms(lambda: batched(model, qry_fts, prototypes), args.n_iter, device)
+        print(f"{n_ways:5d} {loop_ms:10.2f} {batch_ms:11.2f} {loop_ms / batch_ms:8.2f} {diff:13.3e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+CPU time per ODE evaluation of the eager ODEfunc against its TorchScript compiled dynamics
+
+"scripted" is ODEfunc.script(), which shares the parameters with the eager module and can be
+trained. "frozen" additionally inlines the eval mode parameters as constants with
+torch.jit.freeze and torch.jit.optimize_for_inference, which is only valid for fixed weights.
+
+    python -m benchmarks.scripted_odefunc --batch_size 2 --size 32
+"""
+import argparse
+
+import torch
+
+from models.ode import ODEfunc
+from benchmarks.common import get_device
+from benchmarks.concat_conv import time_per_eval
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--size", type=int, default=32, help="encoder feature resolution")
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--ode_layers", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--n_iter", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = get_device(args.device)
+    eager = ODEfunc(args.dim, n_layers=args.ode_layers).to(device).eval()
+    scripted = ODEfunc(args.dim, n_layers=args.ode_layers).to(device).eval()
+    scripted.load_state_dict(eager.state_dict())
+    scripted.script()
+    frozen = torch.jit.optimize_for_inference(torch.jit.freeze(torch.jit.script(eager.dynamics).eval()))
+    x = torch.randn(args.batch_size, args.dim, args.size, args.size, device=device)
+    t = torch.tensor(1.5, device=device)
+
+    with torch.no_grad():
+        reference = eager(t, x)
+        funcs = {"eager": eager, "scripted": scripted, "frozen": frozen}
+        times = time_per_eval(funcs, t, x, args.n_iter, device)
+        print(f"{'odefunc':>9} {'ms / eval':>10} {'max abs diff':>13}")
+        for name, func in funcs.items():
+            diff = (func(t, x) - reference).abs().max().item()
+            print(f"{name:>9} {times[name]:10.2f} {diff:13.3e}")
+
+
+if __name__ == "__main__":
+    main()
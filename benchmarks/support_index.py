@@ -0,0 +1,56 @@
+"""
+Search latency and recall of the exact and IVF support slice index
+
+The embeddings are random clusters standing in for the slices of many support volumes, the
+queries perturbed copies of them. Recall is the fraction of queries whose nearest slice the IVF
+search returns, taking the exact search as the reference.
+
+    python -m benchmarks.support_index --n_slices 20000 --n_lists 64 --n_probe 4
+"""
+import argparse
+import time
+
+import torch
+
+from dataloaders_medical.support_index import SupportIndex
+
+
+def clustered_embeddings(n_slices, dim, n_clusters, spread=0.3):
+    centres = torch.randn(n_clusters, dim)
+    return centres[torch.randint(n_clusters, (n_slices,))] + spread * torch.randn(n_slices, dim)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n_slices", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--n_clusters", type=int, default=200)
+    parser.add_argument("--n_lists", type=int, default=64)
+    parser.add_argument("--n_probe", type=int, default=4)
+    parser.add_argument("--n_queries", type=int, default=200)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    embeddings = clustered_embeddings(args.n_slices, args.dim, args.n_clusters)
+    paths = [str(i) for i in range(args.n_slices)]
+    queries = embeddings[torch.randint(args.n_slices, (args.n_queries,))] + 0.1 * torch.randn(args.n_queries, args.dim)
+
+    tic = time.perf_counter()
+    indices = {"exact": SupportIndex(embeddings, paths, paths)}
+    build_exact = time.perf_counter() - tic
+    tic = time.perf_counter()
+    indices["ivf"] = SupportIndex(embeddings, paths, paths, n_lists=args.n_lists)
+    build_ivf = time.perf_counter() - tic
+
+    nearest = {}
+    print(f"{'index':>6} {'build s':>8} {'us / query':>11} {'recall@1':>9}")
+    for (name, index), build in zip(indices.items(), [build_exact, build_ivf]):
+        tic = time.perf_counter()
+        nearest[name] = torch.stack([index.search(query, k=1, n_probe=args.n_probe)[1] for query in queries])
+        us = (time.perf_counter() - tic) / args.n_queries * 1e6
+        recall = (nearest[name] == nearest["exact"]).float().mean().item()
+        print(f"{name:>6} {build:8.2f} {us:11.1f} {recall:9.3f}")
+
+
+if __name__ == "__main__":
+    main()
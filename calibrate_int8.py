@@ -0,0 +1,47 @@
+"""Int8 Calibration Script"""
+import time
+
+import torch
+import torch.quantization as tq
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from models.ode import FewShotSegOde
+from models.checkpoint import load_snapshot
+from models.quantize import prepare_int8, save_int8
+from dataloaders_medical.prostate import meta_data
+from util.utils import set_seed
+from test_config import ex
+
+
+@ex.automain
+def main(_run, _config, _log):
+    """
+    Quantise the snapshot to int8 with activation ranges observed on training episodes of the
+    other organs, and write it to _config['int8'] for test_attacked.py
+    """
+    if not _config["use_ode"] or not _config["int8"]:
+        raise ValueError("calibration quantises a FewShotSegOde snapshot to the path int8")
+    set_seed(_config['seed'])
+
+    _log.info('###### Create model ######')
+    model = FewShotSegOde(pretrained_path=None, pretrained_ode=_config["pretrain_ode"], ode_layers=_config["ode_layers"], ode_time=_config["ode_time"], noise_type=_config["feat_noise_type"], sigma=_config["gaussian_std"], ode_solver=_config["ode_solver"], ode_backprop=_config["ode_backprop"], ode_script=_config["ode_script"], ode_conv=_config["ode_conv"], ode_conv_groups=_config["ode_conv_groups"], ode_conv_rank=_config["ode_conv_rank"], ode_pool=_config["ode_pool"], proto_pooling=_config["proto_pooling"], low_res_logits=_config["low_res_logits"])
+    load_snapshot(model, _config['snapshot'])
+    model.prepare_inference()
+    prepare_int8(model, ode=_config["int8_ode"])
+
+    _log.info('###### Load data ######')
+    _config["data_src"] = _config["data_srcs"][_config["dataset"]]
+    tr_dataset, _, _ = meta_data(dict(_config, n_iter=_config["calib_episodes"]))
+    trainloader = DataLoader(dataset=tr_dataset, batch_size=1, shuffle=False, pin_memory=False, drop_last=False)
+
+    _log.info('###### Calibration ######')
+    tic = time.perf_counter()
+    for sample in tqdm(trainloader):
+        s_x = sample['s_x'].squeeze(2)  # [B, Support, 1, 256, 256]
+        s_y = sample['s_y'].squeeze(2).squeeze(2)  # [B, Support, 256, 256]
+        q_x = sample['q_x'].squeeze(1)  # [B, 1, 256, 256]
+        model.predict(s_x, s_y, q_x)
+    tq.convert(model, inplace=True)
+    save_int8(model, _config["int8"], ode=_config["int8_ode"], snapshot=_config["snapshot"])
+    _log.info(f'{len(trainloader)} episodes observed in {time.perf_counter() - tic:.0f}s, int8 model saved to {_config["int8"]}')
@@ -52,6 +52,40 @@ def cfg():
     ode_layers = 3
     ode_time = 4
     pretrain_ode = False
+    ode_solver = {
+        'method': 'dopri5',  # adaptive 'dopri5', or fixed step 'euler' / 'midpoint' / 'rk4'
+        'tol': 1e-3,
+        'n_steps': 8,  # steps taken by the fixed step methods
+        'max_num_steps': None,  # step cap for the adaptive methods
+        'max_nfe': None,  # function evaluations allowed per forward, None for no cap
+        'fallback': 'rk4',  # fixed step method used when max_nfe is hit
+        'fallback_steps': 4,
+        'adjoint_tol': None,  # tolerance of the backward adjoint solve, None to reuse tol
+        'checkpoint_segments': 2,  # segments recomputed in backward by ode_backprop='checkpointed'
+        'warm_start': True,  # start adaptive solves from the first step accepted by the previous one
+        'sde': None,  # 'euler_maruyama' or 'milstein' to integrate feat_noise_type noise as an SDE on the n_steps grid
+        'sde_samples': 8,  # Monte-Carlo noise paths, batched into one solve
+        'per_sample': False,  # dopri5 with its own step size for every sample of the batch
+        'autocast': None,  # 'bfloat16' (CPU or GPU) or 'float16' (GPU) ODE function evaluations, fp32 state
+        'equilibrium': False,  # at inference, solve for the steady state f(x) = 0 instead of integrating
+        'eq_tol': 1e-3,  # relative feature change at which the steady state is accepted
+        'eq_max_iter': 30,  # Anderson iterations before falling back to the normal solve
+        'eq_memory': 5,  # past iterates combined by Anderson acceleration
+        'eq_step': 0.5,  # pseudo time step of the damped fixed point iteration
+        'profile': False,  # synchronise CUDA after every ODE evaluation so that ode.func_time is device time
+    }
+    ode_backprop = 'direct'  # 'direct', 'adjoint' or 'checkpointed'
+    ode_script = False  # evaluate the ODE dynamics through TorchScript
+    ode_conv = 'dense'  # 'dense', 'separable', 'grouped' or 'lowrank' convolutions in the ODE dynamics
+    ode_conv_groups = 8  # groups of ode_conv='grouped'
+    ode_conv_rank = 64  # bottleneck channels of ode_conv='lowrank'
+    ode_pool = 1  # integrate the ODE on features pooled by this factor, 2 or 4 cut the cost per NFE 4x or 16x
+    proto_pooling = 'upsample'  # 'upsample' features to the mask size, or pool at feature resolution: 'exact' (same prototypes) or 'area'
+    low_res_logits = False  # score the queries at feature resolution and only upsample the final prediction
+    ode_reg = {
+        'kinetic': 0.,  # weight of the integrated kinetic energy of the ODE dynamics
+        'jacobian': 0.,  # weight of the integrated Jacobian Frobenius norm (Hutchinson estimate)
+    }
 
     ### Attack configs
     # attack = "PGD"
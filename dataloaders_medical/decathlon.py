@@ -60,6 +60,7 @@ class Base_dataset():
         self.label_paths = label_paths
         self.n_shot = config["n_shot"]
         self.s_idx = config["s_idx"]
+        self.support_index = None
 
         self.is_train = True
         if str(self.__class__).split(".")[-1][:4]=="Test":
@@ -93,10 +94,7 @@ class Base_dataset():
 
             for i in range(len(s_img_paths)):
                 img_path, label_path = s_img_paths[i], s_label_paths[i]
-                img = self.img_load(img_path, seed)
-                img = resize(img, dsize=(self.size, self.size), interpolation=cv2.INTER_AREA)
-                img = np.expand_dims(img, axis=0)
-                imgs.append(img)
+                imgs.append(self.load_image(img_path, seed))
                 label = np.load(label_path)
                 label = resize(label, dsize=(self.size, self.size), interpolation=cv2.INTER_NEAREST)
                 label = np.expand_dims(label, axis=0)
@@ -114,10 +112,7 @@ class Base_dataset():
         imgs, labels = [],[]
         for i in range(len(q_img_paths)):
             img_path, label_path = q_img_paths[i], q_label_paths[i]
-            img = self.img_load(img_path, seed)
-            img = resize(img, dsize=(self.size, self.size), interpolation=cv2.INTER_AREA)
-            img = np.expand_dims(img, axis=0)
-            imgs.append(img)
+            imgs.append(self.load_image(img_path, seed))
             label = np.load(label_path)
             label = resize(label, dsize=(self.size, self.size), interpolation=cv2.INTER_NEAREST)
             label = np.expand_dims(label, axis=0)
@@ -142,6 +137,21 @@ class Base_dataset():
         }
         return sample
 
+    def load_image(self, img_path, seed=0):
+        ## load and resize a slice to [1, size, size]
+        img = self.img_load(img_path, seed)
+        img = resize(img, dsize=(self.size, self.size), interpolation=cv2.INTER_AREA)
+        return np.expand_dims(img, axis=0)
+
+    def set_support_index(self, index, embed, n_probe=1):
+        """
+        choose the support slices of every query by nearest embedding in a SupportIndex
+        :param embed: function from a [1, 1, size, size] image tensor to its embedding
+        """
+        self.support_index = index
+        self.embed = embed
+        self.n_probe = n_probe
+
     def handle_idx(self, s_n, q_idx, q_n):
         """
         choose slices for support and query volume
@@ -196,11 +206,17 @@ class Base_dataset():
         #     print(k, ": ", to_print)
         return to_return
 
-    def getitme_test(self, idx):
-        q_subj_idx, q_idx = self.get_test_subj_idx(idx)
-        q_subj_img_path = self.img_paths[q_subj_idx]
-        q_subj_label_path = self.label_paths[q_subj_idx]
-        q_fnames = self.img_lists[q_subj_idx]
+    def get_support_paths(self, q_idx, q_n, q_img_path=None):
+        """
+        choose the slice of every support volume for query slice q_idx of a q_n slice volume.
+        With a support index, the n_shot slices nearest to the query image are chosen instead.
+        :return: s_img_paths_all, s_label_paths_all
+        """
+        if self.support_index is not None and q_img_path is not None:
+            query = torch.from_numpy(self.load_image(q_img_path)).float()[None]
+            _, indices = self.support_index.search(self.embed(query), k=self.n_shot, n_probe=self.n_probe)
+            return ([[self.support_index.img_paths[i]] for i in indices.tolist()],
+                    [[self.support_index.label_paths[i]] for i in indices.tolist()])
 
         s_img_paths_all, s_label_paths_all = [],[]
         for s_idx in range(self.n_shot):
@@ -208,13 +224,22 @@ class Base_dataset():
             s_subj_label_path = self.s_label_paths[s_idx]
             s_fnames = self.s_fnames_list[s_idx]
             ## choose support and query slice
-            s_idx = self.handle_idx(len(s_fnames), q_idx, len(q_fnames))
+            s_idx = self.handle_idx(len(s_fnames), q_idx, q_n)
             s_fnames_selected = s_fnames[s_idx:s_idx+1]
             ## define path, load data, and return
             s_img_paths_selected = [f"{s_subj_img_path}/{fname}" for fname in s_fnames_selected]
             s_label_paths_selected = [f"{s_subj_label_path}/{fname}" for fname in s_fnames_selected]
             s_img_paths_all.append(s_img_paths_selected)
             s_label_paths_all.append(s_label_paths_selected)
+        return s_img_paths_all, s_label_paths_all
+
+    def getitme_test(self, idx):
+        q_subj_idx, q_idx = self.get_test_subj_idx(idx)
+        q_subj_img_path = self.img_paths[q_subj_idx]
+        q_subj_label_path = self.label_paths[q_subj_idx]
+        q_fnames = self.img_lists[q_subj_idx]
+
+        s_img_paths_all, s_label_paths_all = self.get_support_paths(q_idx, len(q_fnames), f"{q_subj_img_path}/{q_fnames[q_idx]}")
 
         q_fnames_selected = q_fnames[q_idx:q_idx + 1]
         q_img_paths_selected = [f"{q_subj_img_path}/{fname}" for fname in q_fnames_selected]
@@ -2,6 +2,7 @@ import sys
 import glob
 import json
 import re
+from bisect import bisect_left
 from glob import glob
 from util.utils import *
 from dataloaders_medical.decathlon import *
@@ -23,6 +24,86 @@ class MetaSliceData_train():
         dataset = random.sample(self.datasets, 1)[0]
         return dataset.__getitem__(idx)
 
+class MultiOrganTestLoader():
+    """
+    N-way test episodes, one per query slice of a subject in the test set of any of the organs.
+    The support slices of every organ are chosen from its own support volume, at the position of
+    the query among the organ's slices of the subject, and the query label marks organ w with
+    w + 1. A query slice without a label slice in the folder of an organ has none of that organ.
+    """
+    def __init__(self, datasets):
+        super().__init__()
+        self.datasets = datasets
+        self.label_dirs = [{os.path.basename(path.rstrip("/")): path for path in dataset.label_paths}
+                           for dataset in datasets]
+        # slice numbers of every subject in the folders of every organ
+        self.slice_numbers = [{} for _ in datasets]
+        # the slices of every subject are the union of those of all organs, with their image and label folders
+        slices = {}
+        for way, dataset in enumerate(datasets):
+            for img_path, label_path, fnames in zip(dataset.img_paths, dataset.label_paths, dataset.img_lists):
+                subject = os.path.basename(label_path.rstrip("/"))
+                self.slice_numbers[way][subject] = [int(fname.split(".")[0]) for fname in fnames]
+                for fname in fnames:
+                    slices.setdefault(subject, {}).setdefault(fname, (img_path, label_path))
+        self.subjects = list(slices)
+        self.slices = [sorted(slices[subject].items(), key=lambda item: int(item[0].split(".")[0]))
+                       for subject in self.subjects]
+        self.slice_cnts = [len(subject_slices) for subject_slices in self.slices]
+
+    def __len__(self):
+        return sum(self.slice_cnts)
+
+    def get_cnts(self):
+        return self.slice_cnts
+
+    def get_test_subj_idx(self, idx):
+        for subj_idx, cnt in enumerate(self.slice_cnts):
+            if idx < cnt:
+                return subj_idx, idx
+            idx -= cnt
+        raise IndexError(idx)
+
+    def support_position(self, way, subject, fname, q_idx):
+        """Index and count of the query slice among the organ's slices of the subject, or of the next one"""
+        numbers = self.slice_numbers[way].get(subject)
+        if not numbers:
+            return q_idx, len(self.slices[self.subjects.index(subject)])
+        return min(bisect_left(numbers, int(fname.split(".")[0])), len(numbers) - 1), len(numbers)
+
+    def __getitem__(self, idx):
+        q_subj_idx, q_idx = self.get_test_subj_idx(idx)
+        subject = self.subjects[q_subj_idx]
+        fname, (img_path, label_path) = self.slices[q_subj_idx][q_idx]
+        q_img_paths = [f"{img_path}/{fname}"]
+        query_label_paths = [f"{label_path}/{fname}"]
+
+        s_x, s_y, s_fnames = [], [], []
+        q_y = None
+        for way, dataset in enumerate(self.datasets):
+            s_img_paths, s_label_paths = dataset.get_support_paths(*self.support_position(way, subject, fname, q_idx),
+                                                                   q_img_paths[0])
+            q_label_paths = [f"{self.label_dirs[way].get(subject)}/{fname}"]
+            has_label = os.path.exists(q_label_paths[0])
+            sample = dataset.get_sample(s_img_paths, s_label_paths, q_img_paths,
+                                        q_label_paths if has_label else query_label_paths)
+            if q_y is None:
+                q_x, q_y = sample["q_x"], torch.zeros_like(sample["q_y"])
+            if has_label:
+                q_y[sample["q_y"] > 0] = way + 1
+            s_x.append(sample["s_x"])
+            s_y.append(sample["s_y"])
+            s_fnames.append(s_img_paths)
+
+        return {
+            "s_x": torch.stack(s_x, dim=0), # [Way, Support, slice_num, 1, 256, 256]
+            "s_y": torch.stack(s_y, dim=0),
+            "q_x": q_x,
+            "q_y": q_y, # organ w labelled w + 1
+            "s_fname": s_fnames,
+            "q_fname": q_img_paths,
+        }
+
 def metadata():
     info = {
     "src_dir" : "./organ_data/BCV/Training_2d_nocrop",
@@ -139,6 +220,16 @@ def meta_data(_config):
     return meta_tr_dataset, val_dataset, ts_dataset
 
 
+def multi_organ_data(_config):
+    """val and test sets of N-way episodes over the organs of _config['targets'], with the support volumes of meta_data"""
+    val_datasets, ts_datasets = [], []
+    for target in _config["targets"]:
+        _, val_dataset, ts_dataset = meta_data(dict(_config, target=target))
+        val_datasets.append(val_dataset)
+        ts_datasets.append(ts_dataset)
+    return MultiOrganTestLoader(val_datasets), MultiOrganTestLoader(ts_datasets)
+
+
 def external_testset(_config, target_task):
     def decathlon_spliter(idx):
         def path_collect(idx, option='train'):
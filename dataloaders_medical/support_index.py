@@ -0,0 +1,111 @@
+"""
+Embedding index of the support volume slices, for choosing the support slice of a query by
+nearest neighbour instead of by its relative position in the volume
+"""
+import torch
+import torch.nn.functional as F
+
+
+def embed_slices(encoder, imgs):
+    """L2 normalised, globally average pooled encoder features of images N x 1 x H x W"""
+    return F.normalize(encoder(imgs).mean(dim=(2, 3)), dim=1)
+
+
+def support_slice_paths(dataset):
+    """Image and label paths of every slice of the support volumes of a test dataset"""
+    img_paths, label_paths = [], []
+    for s_img_path, s_label_path, s_fnames in zip(dataset.s_img_paths, dataset.s_label_paths, dataset.s_fnames_list):
+        img_paths += [f"{s_img_path}/{fname}" for fname in s_fnames]
+        label_paths += [f"{s_label_path}/{fname}" for fname in s_fnames]
+    return img_paths, label_paths
+
+
+class SupportIndex():
+    """
+    Cosine similarity index over slice embeddings
+
+    Args:
+        embeddings: N x C slice embeddings
+        img_paths, label_paths: the N slice image and label paths
+        n_lists: number of IVF partitions. 0 searches all slices exactly, otherwise the slices
+            are clustered with spherical k-means and a search only scans the n_probe partitions
+            nearest to the query
+        snapshot: model checkpoint the embeddings were computed with
+    """
+    def __init__(self, embeddings, img_paths, label_paths, n_lists=0, snapshot=None, n_iter=20):
+        super().__init__()
+        self.embeddings = F.normalize(embeddings.float(), dim=1)
+        self.img_paths = list(img_paths)
+        self.label_paths = list(label_paths)
+        self.snapshot = snapshot
+        self.centroids, self.lists = None, None
+        if n_lists > 0:
+            self.centroids, self.lists = self.cluster(min(n_lists, len(self.embeddings)), n_iter)
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def matches(self, dataset, snapshot):
+        """Whether the index holds the support slices of dataset, embedded with snapshot"""
+        img_paths, label_paths = support_slice_paths(dataset)
+        return self.snapshot == snapshot and self.img_paths == img_paths and self.label_paths == label_paths
+
+    def cluster(self, n_lists, n_iter):
+        generator = torch.Generator().manual_seed(0)
+        centroids = self.embeddings[torch.randperm(len(self.embeddings), generator=generator)[:n_lists]]
+        for _ in range(n_iter):
+            assignment = (self.embeddings @ centroids.t()).argmax(dim=1)
+            sums = torch.zeros_like(centroids).index_add_(0, assignment, self.embeddings)
+            # empty partitions keep their centroid
+            centroids = torch.where(sums.norm(dim=1, keepdim=True) > 0, F.normalize(sums, dim=1), centroids)
+        assignment = (self.embeddings @ centroids.t()).argmax(dim=1)
+        return centroids, [torch.nonzero(assignment == i).flatten() for i in range(n_lists)]
+
+    def search(self, query, k=1, n_probe=1):
+        """
+        Top k slices of a single query embedding C
+
+        Returns:
+            cosine similarities and indices of the k nearest slices, in decreasing similarity
+        """
+        query = F.normalize(query.float().flatten(), dim=0).to(self.embeddings.device)
+        candidates = None
+        if self.centroids is not None:
+            probes = (self.centroids @ query).topk(min(n_probe, len(self.lists))).indices
+            candidates = torch.cat([self.lists[i] for i in probes.tolist()])
+            if len(candidates) < k:
+                candidates = None
+        if candidates is None:
+            scores, indices = (self.embeddings @ query).topk(k)
+            return scores, indices
+        scores, indices = (self.embeddings[candidates] @ query).topk(k)
+        return scores, candidates[indices]
+
+    def save(self, path):
+        torch.save({
+            "embeddings": self.embeddings,
+            "img_paths": self.img_paths,
+            "label_paths": self.label_paths,
+            "snapshot": self.snapshot,
+            "centroids": self.centroids,
+            "lists": self.lists,
+        }, path)
+
+    @classmethod
+    def load(cls, path):
+        state = torch.load(path, map_location="cpu")
+        index = cls(state["embeddings"], state["img_paths"], state["label_paths"], snapshot=state["snapshot"])
+        index.centroids, index.lists = state["centroids"], state["lists"]
+        return index
+
+
+def build_support_index(dataset, encoder, n_lists=0, snapshot=None, batch_size=16, device="cpu"):
+    """Embed every slice of the support volumes of a test dataset (set_support_volume)"""
+    img_paths, label_paths = support_slice_paths(dataset)
+    embeddings = []
+    with torch.no_grad():
+        for i in range(0, len(img_paths), batch_size):
+            imgs = torch.stack([torch.from_numpy(dataset.load_image(path)).float()
+                                for path in img_paths[i:i + batch_size]]).to(device)
+            embeddings.append(embed_slices(encoder, imgs).cpu())
+    return SupportIndex(torch.cat(embeddings), img_paths, label_paths, n_lists=n_lists, snapshot=snapshot)
@@ -0,0 +1,67 @@
+"""
+Checkpoint loading with explicit key mapping
+"""
+import inspect
+
+import torch
+import torch.nn as nn
+
+# conv layer indices of torchvision's vgg16 'features'
+VGG16_CONVS = [0, 2, 5, 7, 10, 12, 14, 17, 19, 21, 24, 26, 28]
+
+_TORCH_LOAD_MMAP = "mmap" in inspect.signature(torch.load).parameters
+
+
+def load_checkpoint(path):
+    """
+    Load a state dict to CPU. .safetensors files are read with safetensors, other files are
+    memory-mapped where torch.load supports it (torch >= 2.1 zip checkpoints), so tensors are only
+    paged in when they are copied into a model.
+    """
+    if path.endswith(".safetensors"):
+        from safetensors.torch import load_file
+        return load_file(path, device="cpu")
+    if _TORCH_LOAD_MMAP:
+        try:
+            return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+        except RuntimeError:
+            # legacy (non zip) checkpoints can not be memory-mapped
+            pass
+    return torch.load(path, map_location="cpu")
+
+
+def vgg16_key_map(encoder, skip_convs=2):
+    """
+    Names of the torchvision vgg16 parameters for the conv layers of an Encoder, in order.
+    The first skip_convs layers are left out, the first one because it takes in_channels inputs.
+
+    Returns:
+        dict from Encoder parameter names to vgg16 parameter names
+    """
+    convs = [name for name, module in encoder.named_modules() if isinstance(module, nn.Conv2d)]
+    return {f"{name}.{param}": f"features.{VGG16_CONVS[i]}.{param}"
+            for i, name in enumerate(convs) if skip_convs <= i < len(VGG16_CONVS)
+            for param in ("weight", "bias")}
+
+
+def load_mapped(module, state_dict, key_map):
+    """Copy state_dict[key_map[name]] into the parameter name of module, for every key_map entry present"""
+    params = dict(module.named_parameters())
+    missing = []
+    with torch.no_grad():
+        for name, key in key_map.items():
+            if key in state_dict:
+                params[name].copy_(state_dict[key])
+            else:
+                missing.append(key)
+    return missing
+
+
+def strip_prefix(state_dict, prefix="module."):
+    """Keys of an nn.DataParallel state dict without the wrapper prefix"""
+    return {key[len(prefix):] if key.startswith(prefix) else key: value for key, value in state_dict.items()}
+
+
+def load_snapshot(model, path):
+    """Load a train.py snapshot, saved from nn.DataParallel or not, into the unwrapped model"""
+    model.load_state_dict(strip_prefix(load_checkpoint(path)))
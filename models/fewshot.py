@@ -10,6 +10,58 @@ import torch.nn.functional as F
 
 from .vgg import Encoder
 
+POOLING_MODES = ('upsample', 'exact', 'area')
+
+
+def interpolation_matrix(out_size, in_size, device=None):
+    """
+    in_size x out_size matrix A such that x @ A linearly interpolates x to out_size like
+    F.interpolate(mode='linear'). Bilinear interpolation is the product of one per axis.
+    """
+    eye = torch.eye(in_size, device=device)[None]
+    return F.interpolate(eye, size=out_size, mode='linear', align_corners=False)[0]
+
+
+def predict_labels(logits, size):
+    """
+    Labels B x H x W of logits B x K x H' x W', as if the logits were bilinearly upsampled to size
+    before the argmax. With two classes only the logit difference is upsampled, which is exact
+    because the interpolation is linear.
+    """
+    if logits.shape[-2:] == size:
+        return logits.argmax(dim=1)
+    if logits.shape[1] == 2:
+        diff = F.interpolate(logits[:, 1:] - logits[:, :1], size=size, mode='bilinear')
+        return (diff[:, 0] > 0).long()
+    return F.interpolate(logits, size=size, mode='bilinear').argmax(dim=1)
+
+
+def soft_labels(labels, size, n_classes, ignore_index=None):
+    """
+    Area downsampled one-hot labels: the fraction of every class in each cell of size. Pixels
+    labelled ignore_index belong to no class, so the fractions of a cell sum to its labelled share.
+
+    Args:
+        labels: long labels, expect shape: B x H x W
+    Returns:
+        class fractions B x n_classes x size
+    """
+    if ignore_index is not None:
+        ignored = labels == ignore_index
+        one_hot = F.one_hot(labels.masked_fill(ignored, 0), n_classes).masked_fill(ignored[..., None], 0)
+    else:
+        one_hot = F.one_hot(labels, n_classes)
+    return F.adaptive_avg_pool2d(one_hot.permute(0, 3, 1, 2).float(), size)
+
+
+def soft_cross_entropy(logits, targets):
+    """
+    Cross entropy of logits B x K x H' x W' against class fractions of the same shape, averaged
+    over the labelled share of the cells. At the label resolution this is nn.CrossEntropyLoss with
+    the ignore_index given to soft_labels.
+    """
+    return -(targets * F.log_softmax(logits, dim=1)).sum() / targets.sum().clamp(min=1e-6)
+
 
 class FewShotSeg(nn.Module):
     """
@@ -22,14 +74,30 @@ class FewShotSeg(nn.Module):
             path of the model for initialization
         cfg:
             model configurations
+        pooling:
+            how the support features are masked average pooled into prototypes. 'upsample'
+            upsamples the features to the mask size, 'exact' gives the same prototypes by pulling
+            the masks back to the feature resolution through the transposed bilinear
+            interpolation, and 'area' approximates it with area downsampled masks.
+        low_res_logits:
+            return the query logits at feature resolution instead of upsampling them to the image
+            size. Train against soft_labels and take predictions with predict_labels.
+        encoder:
+            encoder module replacing the default VGG encoder, which is then not built
     """
-    def __init__(self, in_channels=1, pretrained_path=None):
+    def __init__(self, in_channels=1, pretrained_path=None, pooling='upsample', low_res_logits=False, encoder=None):
         super().__init__()
         self.pretrained_path = pretrained_path
+        if pooling not in POOLING_MODES:
+            raise ValueError("prototype pooling must be one of {}, got {}".format(POOLING_MODES, pooling))
+        self.pooling = pooling
+        self.low_res_logits = low_res_logits
 
         # Encoder
-        self.encoder = nn.Sequential(OrderedDict([
-            ('backbone', Encoder(in_channels, self.pretrained_path)),]))
+        if encoder is None:
+            encoder = nn.Sequential(OrderedDict([
+                ('backbone', Encoder(in_channels, self.pretrained_path)),]))
+        self.encoder = encoder
 
 
     def forward(self, supp_imgs, fore_mask, back_mask, qry_imgs, factor=1, return_feats=False):
@@ -45,16 +113,88 @@ class FewShotSeg(nn.Module):
                 N x [B x 1 x H x W], list of tensors
         """
         self.factor = factor
+
+        ###### Extract features ######
+        img_fts = self.encoder(self.concat_images(supp_imgs, qry_imgs))
+        return self.segment(img_fts, supp_imgs, fore_mask, qry_imgs, return_feats=return_feats)
+
+    def concat_images(self, supp_imgs, qry_imgs):
+        """Stack support and query images into a single encoder batch"""
+        return torch.cat([torch.cat(way, dim=0) for way in supp_imgs]
+                         + [torch.cat(qry_imgs, dim=0),], dim=0)
+
+    def encode_support(self, supp_imgs):
+        """
+        Encode the support images on their own
+
+        Args:
+            supp_imgs: way x shot x [B x 1 x H x W], list of lists of tensors
+
+        Returns:
+            support features (Wa x Sh x B) x C x H' x W', in the order of concat_images
+        """
+        return self.encoder(torch.cat([torch.cat(way, dim=0) for way in supp_imgs], dim=0))
+
+    def forward_support(self, supp_fts, supp_imgs, fore_mask, back_mask, qry_imgs, factor=1, return_feats=False):
+        """
+        forward with the support features supp_fts given by encode_support, so that a fixed
+        support is encoded once for all of its queries. Only the queries go through the encoder.
+        """
+        self.factor = factor
+        qry_fts = self.encoder(torch.cat(qry_imgs, dim=0))
+        return self.segment(torch.cat([supp_fts, qry_fts], dim=0), supp_imgs, fore_mask, qry_imgs,
+                            return_feats=return_feats)
+
+    def prepare_inference(self):
+        """
+        Convert the encoder backbone to channels_last for predict. Call it once at setup, outside
+        of inference mode, so that the parameters stay usable by forward and the attacks.
+        """
+        with torch.no_grad():
+            self.encoder.backbone.to(memory_format=torch.channels_last)
+        return self
+
+    @torch.inference_mode()
+    def predict(self, support, support_mask, queries, probabilities=False, factor=1):
+        """
+        Inference only forward of an episode batch on stacked tensors. The images are passed to
+        the encoder in channels_last memory format, which prepare_inference extends to the
+        backbone, and no prototypes or features are returned. All ways are scored in the same pass.
+
+        Args:
+            support: support images, expect shape: B x [Wa x] Sh x 1 x H x W
+            support_mask: foreground masks of the support images, expect shape: B x [Wa x] Sh x H x W
+            queries: query images, expect shape: B x 1 x H x W
+            probabilities: return the softmax of the logits
+            factor: shot divisor of the prototypes, as in forward
+
+        Returns:
+            B x (1 + Wa) x H x W logits, or probabilities. At feature resolution with low_res_logits.
+        """
+        if support.dim() == 5:
+            support, support_mask = support[:, None], support_mask[:, None]
+        supp_imgs = [list(way.unbind(dim=1)) for way in support.unbind(dim=1)]
+        fore_mask = [list(way.unbind(dim=1)) for way in support_mask.unbind(dim=1)]
+        imgs = torch.cat([support.permute(1, 2, 0, 3, 4, 5).flatten(0, 2), queries], dim=0)  # Wa x Sh x B order
+        img_fts = self.encoder(imgs.contiguous(memory_format=torch.channels_last)).contiguous()
+        logits = self.segment(img_fts, supp_imgs, fore_mask, [queries], factor=factor)[0]
+        return logits.softmax(dim=1) if probabilities else logits
+
+    def segment(self, img_fts, supp_imgs, fore_mask, qry_imgs, return_feats=False, factor=None):
+        """
+        Predict the query segmentation from the encoded support and query images
+
+        Args:
+            img_fts: features of concat_images(supp_imgs, qry_imgs)
+                expect shape: (Wa x Sh x B + N x B) x C x H' x W'
+            supp_imgs, fore_mask, qry_imgs: the inputs of forward
+            factor: shot divisor of the prototypes, self.factor set by forward if None
+        """
         n_ways = len(supp_imgs)
         n_shots = len(supp_imgs[0])
         n_queries = len(qry_imgs)
         batch_size = supp_imgs[0][0].shape[0]
         img_size = supp_imgs[0][0].shape[-2:]
-
-        ###### Extract features ######
-        imgs_concat = torch.cat([torch.cat(way, dim=0) for way in supp_imgs]
-                                + [torch.cat(qry_imgs, dim=0),], dim=0)
-        img_fts = self.encoder(imgs_concat)
         fts_size = img_fts.shape[-2:]
 
         supp_fts = img_fts[:n_ways * n_shots * batch_size].view(
@@ -67,55 +207,98 @@ class FewShotSeg(nn.Module):
         #                          for way in back_mask], dim=0)  # Wa x Sh x B x H x W
 
         back_mask = torch.ones_like(fore_mask) - fore_mask
-        ###### Compute loss ######
-        outputs = []
-        all_prototypes = []
-        all_fg_prototypess = []
-        for epi in range(batch_size):
-            ###### Extract prototype ######
-            supp_fg_fts = [[self.getFeatures(supp_fts[way, shot, [epi]],
-                                             fore_mask[way, shot, [epi]])
-                            for shot in range(n_shots)] for way in range(n_ways)]
-            supp_bg_fts = [[self.getFeatures(supp_fts[way, shot, [epi]],
-                                             back_mask[way, shot, [epi]])
-                            for shot in range(n_shots)] for way in range(n_ways)]
-
-            ###### Obtain the prototypes######
-            fg_prototypes, bg_prototype = self.getPrototype(supp_fg_fts, supp_bg_fts)
-
-            ###### Compute the distance ######
-            prototypes = [bg_prototype,] + fg_prototypes
-            dist = [self.calDist(qry_fts[:, epi], prototype) for prototype in prototypes]
-            all_prototypes += prototypes
-            all_fg_prototypess += fg_prototypes
-            
-            pred = torch.stack(dist, dim=1)  # N x (1 + Wa) x H' x W'
-            outputs.append(F.interpolate(pred, size=img_size, mode='bilinear'))
-
-        all_prototypes = torch.stack(all_prototypes,  dim=0)
-        all_fg_prototypess = torch.stack(all_fg_prototypess,  dim=0)
-        output = torch.stack(outputs, dim=1)  # N x B x (1 + Wa) x H x W
-        output = output.view(-1, *output.shape[2:])
+
+        ###### Extract prototypes of all episodes, ways and shots at once ######
+        masks = torch.stack([fore_mask, back_mask], dim=-3)  # Wa x Sh x B x 2 x H x W
+        supp_fg_fts, supp_bg_fts = self.maskedPooling(supp_fts, masks).unbind(dim=-2)  # Wa x Sh x B x C
+        fg_prototypes, bg_prototype = self.getPrototypes(supp_fg_fts, supp_bg_fts,
+                                                         self.factor if factor is None else factor)
+        prototypes = torch.cat([bg_prototype[:, None], fg_prototypes.transpose(0, 1)], dim=1)  # B x (1 + Wa) x C
+
+        ###### Compute the distance ######
+        dist = self.calDists(qry_fts, prototypes)  # N x B x (1 + Wa) x H' x W'
+        output = dist.flatten(0, 1)  # (N x B) x (1 + Wa) x H' x W'
+        if not self.low_res_logits:
+            output = F.interpolate(output, size=img_size, mode='bilinear')  # (N x B) x (1 + Wa) x H x W
+
+        all_prototypes = prototypes.reshape(-1, 1, prototypes.shape[-1])
+        all_fg_prototypess = fg_prototypes.transpose(0, 1).reshape(-1, 1, prototypes.shape[-1])
         if return_feats:
             return output, all_prototypes, qry_fts
         return output, all_fg_prototypess
 
+    def maskedPooling(self, fts, mask):
+        """
+        Batched getFeatures: masked average pooling of features at the mask size, in the way
+        selected by self.pooling. With 'upsample', every feature map is upsampled once for all of
+        its masks; the other modes never leave the feature resolution.
+
+        Args:
+            fts: input features, expect shape: ... x C x H' x W'
+            mask: binary masks, expect shape: ... x M x H x W, with the same leading dimensions
+
+        Returns:
+            pooled features ... x M x C
+        """
+        size = fts.shape[:-3]
+        fts = fts.flatten(0, -4)
+        mask = mask.flatten(0, -4)
+        fts_size, mask_size = fts.shape[-2:], mask.shape[-2:]
+        if self.pooling == 'upsample':
+            fts = F.interpolate(fts, size=mask_size, mode='bilinear')
+            weights = mask
+        elif self.pooling == 'exact':
+            # sum(upsample(f) * m) = sum(f * A_h m A_w^T), with the interpolation matrices A
+            weights = torch.einsum('yY,nmYX,xX->nmyx',
+                                   interpolation_matrix(mask_size[0], fts_size[0], mask.device), mask,
+                                   interpolation_matrix(mask_size[1], fts_size[1], mask.device))
+        else:
+            weights = F.adaptive_avg_pool2d(mask, fts_size) * (mask_size.numel() / fts_size.numel())
+        masked_fts = torch.einsum('nchw,nmhw->nmc', fts, weights) \
+            / (mask.sum(dim=(2, 3))[..., None] + 1e-5)
+        return masked_fts.view(*size, *masked_fts.shape[1:])
+
+    def getPrototypes(self, fg_fts, bg_fts, factor):
+        """
+        Batched getPrototype
+
+        Args:
+            fg_fts: foreground features, expect shape: Wa x Sh x B x C
+            bg_fts: background features, expect shape: Wa x Sh x B x C
+            factor: only the first Sh // factor shots are averaged when Sh > factor
+
+        Returns:
+            foreground prototypes Wa x B x C and background prototypes B x C
+        """
+        n_shots = fg_fts.shape[1]
+        if n_shots > factor:
+            n_shots = n_shots // factor
+        fg_prototypes = fg_fts[:, :n_shots].mean(dim=1)
+        bg_prototype = bg_fts[:, :n_shots].mean(dim=1).mean(dim=0)
+        return fg_prototypes, bg_prototype
+
     def get_sup_fore(self, sup, fore_mask):
-        # print(len(sup), len(sup[0]), len(sup[0][0]), len(sup[0][0][0]), len(sup[0][0][0][0]))
-        batch_size = sup[0].shape[0]
-        # print("batch size: ", batch_size)
-        # sup = torch.cat([torch.cat(sample, dim=0) for sample in sup])
-        sup = torch.cat(sup, dim=0)
-        sup = sup.squeeze(1)
-        # print(sup.shape)
-        supp_fts = self.encoder(sup)
-        # print(len(fore_mask), len(fore_mask[0]), len(fore_mask[0][0]), fore_mask[0][0][0].shape)
-        num_samples = (supp_fts.shape[0]//batch_size)
-        # print(num_samples)
-        # print(supp_fts.shape, fore_mask.shape)
-        supp_fg_fts = [self.getFeatures(supp_fts[i, ...].unsqueeze(0),  fore_mask[i%num_samples][0][i//num_samples].unsqueeze(0)) for i in range(supp_fts.shape[0])]
-        supp_fg_fts = [torch.cat(supp_fg_fts[i*batch_size: (i+1)*batch_size], dim=0) for i in range(len(supp_fg_fts)//batch_size)]
-        return supp_fg_fts
+        """
+        Encode several perturbed copies of the support and pool their foreground prototypes, all
+        in one batch
+
+        Args:
+            sup: support images of every copy
+                expect shape: S x [B x Sh x 1 x H x W], list of tensors
+            fore_mask: foreground masks of every copy
+                expect shape: S x Sh x [B x H x W], list of lists of tensors
+
+        Returns:
+            support features S x (B x Sh) x C x H' x W' and foreground prototypes S x B x C
+        """
+        if len(fore_mask) != len(sup):
+            raise ValueError("got {} support copies but {} mask sets".format(len(sup), len(fore_mask)))
+        n_samples, batch_size, n_shots = len(sup), sup[0].shape[0], sup[0].shape[1]
+        supp_fts = self.encoder(torch.stack(sup, dim=0).flatten(0, 2))  # (S x B x Sh) x C x H' x W'
+        supp_fts = supp_fts.view(n_samples, batch_size, n_shots, *supp_fts.shape[1:])
+        masks = torch.stack([torch.stack(shots, dim=1) for shots in fore_mask], dim=0)  # S x B x Sh x H x W
+        supp_fg_fts = self.maskedPooling(supp_fts, masks[..., None, :, :])[..., 0, :]  # S x B x Sh x C
+        return supp_fts.flatten(1, 2), supp_fg_fts.mean(dim=2)
 
 
     def calDist(self, fts, prototype, scaler=20):
@@ -132,6 +315,26 @@ class FewShotSeg(nn.Module):
         return dist
 
 
+    def calDists(self, fts, prototypes, scaler=20):
+        """
+        Batched calDist: cosine similarity of the features to all prototypes in one matmul. The
+        features and prototypes are each normalised once, instead of once per prototype.
+
+        Args:
+            fts: input features
+                expect shape: ... x C x H x W
+            prototypes: prototypes of all semantic classes
+                expect shape: ... x K x C, with leading dimensions broadcastable to the ones of fts
+
+        Returns:
+            scaled similarities ... x K x H x W
+        """
+        fts = F.normalize(fts, dim=-3, eps=1e-8)
+        prototypes = F.normalize(prototypes, dim=-1, eps=1e-8)
+        dist = torch.matmul(prototypes, fts.flatten(-2)) * scaler
+        return dist.view(*dist.shape[:-1], *fts.shape[-2:])
+
+
     def getFeatures(self, fts, mask):
         """
         Extract foreground and background features via masked average pooling
@@ -1,10 +1,12 @@
 import os
 import argparse
 import logging
+import math
 import time
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.utils.data import DataLoader
 import torchvision.datasets as datasets
 import torchvision.transforms as transforms
@@ -12,8 +14,279 @@ from .fewshot import FewShotSeg
 from collections import OrderedDict
 from .vgg import Encoder
 
-from torchdiffeq import odeint
-# from torchdiffeq import odeint_adjoint as odeint
+from torch.utils.checkpoint import checkpoint
+from torchdiffeq import odeint, odeint_adjoint
+from torchdiffeq._impl.odeint import SOLVERS
+from torchdiffeq._impl.rk_common import RKAdaptiveStepsizeODESolver
+from torchdiffeq._impl.dopri5 import _DORMAND_PRINCE_SHAMPINE_TABLEAU
+
+FIXED_GRID_SOLVERS = ("euler", "midpoint", "rk4")
+BACKPROP_MODES = ("direct", "adjoint", "checkpointed")
+SDE_SOLVERS = ("euler_maruyama", "milstein")
+ODE_CONVS = ("dense", "separable", "grouped", "lowrank")
+NOISE_TYPES = ("additive", "multiplicative")
+
+DEFAULT_SOLVER = {
+    "method": "dopri5",
+    "tol": 1e-3,
+    "n_steps": 8,
+    "max_num_steps": None,
+    "max_nfe": None,
+    "fallback": "rk4",
+    "fallback_steps": 4,
+    "adjoint_tol": None,
+    "checkpoint_segments": 2,
+    "warm_start": True,
+    "sde": None,
+    "sde_samples": 8,
+    "per_sample": False,
+    "autocast": None,
+    "equilibrium": False,
+    "eq_tol": 1e-3,
+    "eq_max_iter": 30,
+    "eq_memory": 5,
+    "eq_step": 0.5,
+    "profile": False,
+}
+
+
+def last_state(out):
+    """Final time point of an odeint solution, for plain and tuple states"""
+    if isinstance(out, tuple):
+        return tuple(o[-1] for o in out)
+    return out[-1]
+
+
+def stack_states(states):
+    """Stack a list of plain or tuple states along a new leading time dimension"""
+    if isinstance(states[0], tuple):
+        return tuple(torch.stack(s) for s in zip(*states))
+    return torch.stack(states)
+
+
+def sample_rms(x):
+    """Root mean square of every sample of a batch"""
+    return x.pow(2).flatten(1).mean(1).sqrt()
+
+
+def per_sample_dopri5(func, y0, t, rtol, atol, first_step=None, max_num_steps=None, stats=None):
+    """
+    Dormand-Prince solve in which every sample of the batch has its own time and step size
+
+    Each iteration evaluates func on the samples that have not reached t[-1] yet, with one time
+    per sample, so an easy sample finishes in few steps and drops out of the batch instead of
+    following the smallest step any sample needs. Steps are clamped to land exactly on the output
+    times, and step size selection follows torchdiffeq (error ratio, safety 0.9, factors 0.2 to
+    10), applied per sample.
+
+    Returns:
+        states at the times t, len(t) x B x ...
+    """
+    tableau = _DORMAND_PRINCE_SHAMPINE_TABLEAU
+    alpha = tableau.alpha.tolist()
+    beta = [b.tolist() for b in tableau.beta]
+    c_error = tableau.c_error.tolist()
+    order = 5
+    n = y0.shape[0]
+    shape = (-1,) + (1,) * (y0.dim() - 1)
+    t = t.to(y0)
+
+    t_now = t[0].expand(n).clone()
+    f = func(t_now, y0)
+    with torch.no_grad():
+        if first_step is not None:
+            dt = torch.full_like(t_now, first_step)
+        else:
+            scale = atol + y0.abs() * rtol
+            d0, d1 = sample_rms(y0 / scale), sample_rms(f / scale)
+            h0 = torch.where((d0 < 1e-5) | (d1 < 1e-5), torch.full_like(d0, 1e-6), 0.01 * d0 / d1)
+            f1 = func(t_now + h0, y0 + h0.view(shape) * f)
+            d2 = sample_rms((f1 - f) / scale) / h0
+            h1 = torch.where((d1 <= 1e-15) & (d2 <= 1e-15), torch.clamp(h0 * 1e-3, min=1e-6),
+                             (0.01 / torch.max(d1, d2)) ** (1. / order))
+            dt = torch.min(100 * h0, h1)
+
+    outputs = [[None] * n for _ in range(len(t) - 1)]
+    active = torch.arange(n, device=y0.device)
+    next_output = torch.ones(n, dtype=torch.long, device=y0.device)
+    y = y0
+    n_iter = 0
+    while len(active):
+        n_iter += 1
+        if max_num_steps is not None and n_iter > max_num_steps:
+            raise RuntimeError("max_num_steps exceeded ({})".format(max_num_steps))
+        target = t[next_output]
+        with torch.no_grad():
+            reaches = dt >= target - t_now
+            dt = torch.where(reaches, target - t_now, dt)
+        h = dt.view(shape)
+        k = [f]
+        for a, b in zip(alpha, beta):
+            y1 = y + h * sum(b_j * k_j for b_j, k_j in zip(b, k) if b_j != 0)
+            k.append(func(t_now + a * dt, y1))
+        # the last stage is evaluated at the solution, so k[-1] is the first stage of the next step
+        error = h * sum(c_j * k_j for c_j, k_j in zip(c_error, k) if c_j != 0)
+
+        with torch.no_grad():
+            ratio = sample_rms(error / (atol + rtol * torch.max(y.abs(), y1.abs())))
+            accept = ratio <= 1
+            dfactor = torch.where(accept, torch.ones_like(ratio), torch.full_like(ratio, 0.2))
+            factor = torch.clamp(torch.max(0.9 * ratio ** (-1. / order), dfactor), max=10.)
+            reached = accept & reaches
+            t_now = torch.where(reached, target, torch.where(accept, t_now + dt, t_now))
+            next_dt = dt * factor
+            if stats is not None:
+                for accepted, step, next_step in zip(accept.tolist(), dt.tolist(), next_dt.tolist()):
+                    stats.record_step(accepted, step, next_step)
+            dt = next_dt
+        mask = accept.view(shape)
+        y = torch.where(mask, y1, y)
+        f = torch.where(mask, k[-1], f)
+
+        for i in reached.nonzero().flatten().tolist():
+            outputs[next_output[i] - 1][active[i]] = y[i]
+        next_output = next_output + reached.long()
+        keep = next_output < len(t)
+        active, next_output, t_now, dt = active[keep], next_output[keep], t_now[keep], dt[keep]
+        y, f = y[keep], f[keep]
+
+    return torch.stack([y0] + [torch.stack(samples) for samples in outputs])
+
+
+def anderson(g, x0, memory=5, max_iter=30, tol=1e-3, lam=1e-4):
+    """
+    Anderson acceleration of the fixed point iteration x <- g(x), batched over samples
+
+    Args:
+        g:
+            map of B x D tensors
+        x0:
+            B x D starting point
+        memory:
+            number of past iterates combined in every update
+        tol:
+            stop once the relative change ||g(x) - x|| / ||g(x)|| of every sample is below tol
+
+    Returns:
+        the last iterate and the relative change of every sample at that iterate
+    """
+    n, d = x0.shape
+    memory = max(memory, 2)
+    xs = x0.new_zeros(n, memory, d)
+    gs = x0.new_zeros(n, memory, d)
+    xs[:, 0], gs[:, 0] = x0, g(x0)
+    xs[:, 1], gs[:, 1] = gs[:, 0], g(gs[:, 0])
+    h = x0.new_zeros(n, memory + 1, memory + 1)
+    h[:, 0, 1:] = h[:, 1:, 0] = 1
+    rhs = x0.new_zeros(n, memory + 1, 1)
+    rhs[:, 0] = 1
+
+    k = 1
+    residual = (gs[:, k] - xs[:, k]).norm(dim=1) / (1e-5 + gs[:, k].norm(dim=1))
+    while k + 1 < max_iter and residual.max() > tol:
+        k += 1
+        m = min(k, memory)
+        diff = gs[:, :m] - xs[:, :m]
+        gram = torch.bmm(diff, diff.transpose(1, 2))
+        # regularise relative to the residual sizes, which shrink by orders of magnitude
+        scale = gram.diagonal(dim1=1, dim2=2).max(1)[0].view(-1, 1, 1)
+        h[:, 1:m + 1, 1:m + 1] = gram + lam * scale * torch.eye(m, dtype=x0.dtype, device=x0.device)
+        alpha = torch.linalg.solve(h[:, :m + 1, :m + 1], rhs[:, :m + 1])[:, 1:m + 1, 0]
+        xs[:, k % memory] = torch.bmm(alpha.unsqueeze(1), gs[:, :m]).squeeze(1)
+        gs[:, k % memory] = g(xs[:, k % memory])
+        residual = (gs[:, k % memory] - xs[:, k % memory]).norm(dim=1) / (1e-5 + gs[:, k % memory].norm(dim=1))
+    return xs[:, k % memory], residual
+
+
+class NFEBudgetExceeded(RuntimeError):
+    """Raised by ODEfunc when a single solve needs more evaluations than allowed"""
+
+
+def uniform_grid(n_steps):
+    """
+    Grid constructor for the fixed step solvers taking n_steps uniform steps. Intermediate output
+    times are added to the grid, so they are hit exactly instead of linearly interpolated. The grid
+    runs in the direction of t, the adjoint solves backwards in time.
+    """
+    def grid_constructor(func, y0, t):
+        grid = t[0] + (t[-1] - t[0]) * torch.linspace(0, 1, n_steps + 1, dtype=t.dtype, device=t.device)
+        grid[0], grid[-1] = t[0], t[-1]
+        # unique sorts in increasing order
+        grid = torch.cat([grid, t[1:-1]]).unique()
+        return grid.flip(0) if t[-1] < t[0] else grid
+    return grid_constructor
+
+
+class ODEStats(object):
+    """
+    Solver statistics of a single ODEBlock forward
+
+    The backward fields are filled in by gradient hooks while backpropagating through the solve,
+    so they are only complete after loss.backward(). Only the adjoint solve and the checkpoint
+    recomputation evaluate the ODE function in backward, direct backprop leaves them at zero.
+    On CUDA the func_time fields only cover the kernel launches unless the solver dict sets
+    "profile", which synchronises the device after every evaluation.
+    """
+    def __init__(self):
+        self.nfe_forward = 0
+        self.nfe_backward = 0
+        self.accepted_steps = 0
+        self.rejected_steps = 0
+        self.first_step = float("nan")
+        self.final_step = float("nan")
+        self.next_step = float("nan")
+        self.warm_start = False
+        self.func_time = 0.
+        self.func_time_backward = 0.
+        self.wall_time = 0.
+        self.fallback = False
+        self.equilibrium = False
+
+    def record_step(self, accepted, step, next_step=None):
+        if accepted:
+            if self.accepted_steps == 0:
+                self.first_step = step
+                # the step the controller proposes after it, larger when the first step was too cautious
+                if next_step is not None:
+                    self.next_step = next_step
+            self.accepted_steps += 1
+            self.final_step = step
+        else:
+            self.rejected_steps += 1
+
+    def as_dict(self):
+        stats = dict(vars(self))
+        stats["fallback"] = int(self.fallback)
+        stats["warm_start"] = int(self.warm_start)
+        stats["equilibrium"] = int(self.equilibrium)
+        return stats
+
+
+def tracked_solver(solver_cls):
+    """Subclass of an adaptive torchdiffeq solver recording every step attempt into an ODEStats"""
+    class TrackedSolver(solver_cls):
+        def __init__(self, *args, stats=None, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.stats = stats
+
+        def _adaptive_step(self, rk_state):
+            next_state = super()._adaptive_step(rk_state)
+            if self.stats is not None:
+                # a rejected step leaves the current time of the solver state unchanged
+                self.stats.record_step(bool(next_state.t1 != rk_state.t1), float(rk_state.dt), float(next_state.dt))
+            return next_state
+    return TrackedSolver
+
+
+# The step tracking registers tracked_<method> solvers in the private solver table of torchdiffeq
+# and wraps RKAdaptiveStepsizeODESolver._adaptive_step, both as laid out in torchdiffeq 0.2.x
+# (pinned 0.2.2). With another layout the solves run untracked and the step counts stay at zero.
+TRACKED_SOLVERS = {}
+if hasattr(RKAdaptiveStepsizeODESolver, "_adaptive_step"):
+    for name, solver_cls in list(SOLVERS.items()):
+        if isinstance(solver_cls, type) and issubclass(solver_cls, RKAdaptiveStepsizeODESolver):
+            TRACKED_SOLVERS[name] = "tracked_" + name
+            SOLVERS["tracked_" + name] = tracked_solver(solver_cls)
 
 def conv3x3(in_planes, out_planes, stride=1):
     """3x3 convolution with padding"""
@@ -40,59 +313,592 @@ class ConcatConv2d(nn.Module):
             bias=bias
         )
 
-    def forward(self, t, x):
+    def forward(self, t: torch.Tensor, x: torch.Tensor) -> torch.Tensor:
+        if t.dim() > 0:
+            t = t.view(-1, 1, 1, 1)
         tt = torch.ones_like(x[:, :1, :, :]) * t
         ttx = torch.cat([tt, x], 1)
         return self._layer(ttx)
 
 
+def merge_time_weight(module, state_dict, prefix, local_metadata):
+    """State dict hook saving FusedConcatConv2d in the ConcatConv2d layout"""
+    key = prefix + "_layer.weight"
+    if key not in state_dict:
+        # an int8 _layer (models.quantize) is saved in its own layout, with time_weight apart
+        return
+    time_weight = state_dict.pop(prefix + "time_weight")
+    state_dict[key] = torch.cat([time_weight, state_dict[key]], 1)
+
+
+def split_time_weight(state_dict, prefix):
+    """Split a FusedConcatConv2d state dict in the ConcatConv2d layout back into the time kernel and _layer.weight"""
+    key = prefix + "_layer.weight"
+    if key in state_dict and prefix + "time_weight" not in state_dict:
+        weight = state_dict[key]
+        state_dict[prefix + "time_weight"] = weight[:, :1]
+        state_dict[key] = weight[:, 1:]
+
+
+class FusedConcatConv2d(nn.Module):
+    """
+    ConcatConv2d without materialising the constant time channel
+
+    With zero padding, convolving the plane t * ones gives t times the sum of the time kernel
+    taps that fall inside the image at each position. That map is obtained by convolving a
+    single 1 x 1 x H x W ones plane and added to the convolution of x alone, instead of
+    concatenating a B x 1 x H x W plane onto x before every convolution. t is a scalar tensor
+    or holds one time per sample. State dicts are read and written in the ConcatConv2d layout,
+    with the time kernel as input channel 0 of _layer.weight.
+    """
+
+    def __init__(self, dim_in, dim_out, ksize=3, stride=1, padding=0, dilation=1, bias=True):
+        super(FusedConcatConv2d, self).__init__()
+        # initialise exactly like ConcatConv2d, then split off the time kernel
+        full = nn.Conv2d(dim_in + 1, dim_out, kernel_size=ksize, stride=stride, padding=padding, dilation=dilation, bias=bias)
+        self._layer = nn.utils.skip_init(nn.Conv2d, dim_in, dim_out, kernel_size=ksize, stride=stride, padding=padding,
+                                         dilation=dilation, bias=bias)
+        with torch.no_grad():
+            self._layer.weight.copy_(full.weight[:, 1:])
+            if bias:
+                self._layer.bias.copy_(full.bias)
+        self.time_weight = nn.Parameter(full.weight.detach()[:, :1].clone())
+        self._register_state_dict_hook(merge_time_weight)
+        self._time_map, self._time_map_key = None, None
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        split_time_weight(state_dict, prefix)
+        super(FusedConcatConv2d, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys,
+                                                             unexpected_keys, error_msgs)
+
+    def time_map(self, x):
+        layer = self._layer
+        ones = x.new_ones([1, 1, x.shape[-2], x.shape[-1]])
+        return F.conv2d(ones, self.time_weight, None, layer.stride, layer.padding, layer.dilation)
+
+    @torch.jit.unused
+    def cached_time_map(self, x, dtype: torch.dtype):
+        """
+        time_map, kept across evaluations without gradients until the resolution, device, dtype or
+        time kernel changes. Evaluations that record a graph compute their own, the first backward
+        would free the graph of a shared map.
+        """
+        if torch.is_grad_enabled():
+            return self.time_map(x)
+        weight = self.time_weight
+        key = (x.shape[-2], x.shape[-1], x.device, dtype, weight._version, weight.data_ptr())
+        if key != self._time_map_key:
+            self._time_map, self._time_map_key = self.time_map(x).to(dtype), key
+        return self._time_map
+
+    def forward(self, t: torch.Tensor, x: torch.Tensor) -> torch.Tensor:
+        out = self._layer(x)
+        if t.dim() > 0:
+            t = t.view(-1, 1, 1, 1)
+        if torch.jit.is_scripting():
+            time_map = self.time_map(x)
+        else:
+            time_map = self.cached_time_map(x, out.dtype)
+        # the convolution backward does not need its output, so adding in place is safe
+        out.addcmul_(t, time_map)
+        return out
+
+
+class FactorisedConcatConv2d(nn.Module):
+    """
+    Cheaper time conditioned convolution for the ODE dynamics
+
+    kind "separable" is a depthwise ksize x ksize convolution followed by a pointwise one, "grouped"
+    a ksize x ksize convolution in groups, and "lowrank" a 1x1 projection to rank channels, a
+    ksize x ksize convolution between them and a 1x1 projection back. As in FusedConcatConv2d, the
+    constant time channel enters through its own ksize x ksize kernel convolved with a ones plane.
+    """
+
+    def __init__(self, dim_in, dim_out, ksize=3, stride=1, padding=0, kind="separable", groups=8, rank=64):
+        super(FactorisedConcatConv2d, self).__init__()
+        if kind == "separable":
+            self.body = nn.Sequential(
+                nn.Conv2d(dim_in, dim_in, ksize, stride, padding, groups=dim_in, bias=False),
+                nn.Conv2d(dim_in, dim_out, 1),
+            )
+        elif kind == "grouped":
+            self.body = nn.Sequential(nn.Conv2d(dim_in, dim_out, ksize, stride, padding, groups=groups))
+        elif kind == "lowrank":
+            self.body = nn.Sequential(
+                nn.Conv2d(dim_in, rank, 1, bias=False),
+                nn.Conv2d(rank, rank, ksize, stride, padding, bias=False),
+                nn.Conv2d(rank, dim_out, 1),
+            )
+        else:
+            raise ValueError("ODE conv must be one of {}, got {}".format(ODE_CONVS, kind))
+        self.stride = stride
+        self.padding = padding
+        # the same scale as the weights of a dense ConcatConv2d
+        bound = 1 / math.sqrt((dim_in + 1) * ksize * ksize)
+        self.time_weight = nn.Parameter(torch.empty(dim_out, 1, ksize, ksize).uniform_(-bound, bound))
+
+    def forward(self, t: torch.Tensor, x: torch.Tensor) -> torch.Tensor:
+        out = self.body(x)
+        if t.dim() > 0:
+            t = t.view(-1, 1, 1, 1)
+        ones = x.new_ones([1, 1, x.shape[-2], x.shape[-1]])
+        return out + t * F.conv2d(ones, self.time_weight, None, self.stride, self.padding)
+
+
+class ODEDynamics(nn.Module):
+    """
+    The norm -> relu -> time conditioned conv -> norm chain of ODEfunc as a pure function of
+    (t, x), without the evaluation counting, so that TorchScript can compile it end to end.
+    """
+
+    def __init__(self, norm1, convs, norms):
+        super(ODEDynamics, self).__init__()
+        self.norm1 = norm1
+        self.convs = nn.ModuleList(convs)
+        self.norms = nn.ModuleList(norms)
+
+    def forward(self, t: torch.Tensor, x: torch.Tensor) -> torch.Tensor:
+        out = self.norm1(x)
+        for conv, norm in zip(self.convs, self.norms):
+            out = norm(conv(t, F.relu(out, inplace=True)))
+        return out
+
+
+def checkpoint_prefixes(n_layers):
+    """
+    Pairs of ODEfunc key prefixes, of the registered dynamics and of the checkpoint layout. The
+    checkpoints keep the original norm1 and layers_seq keys, with the convs followed by the norms.
+    """
+    return [("dynamics.norm1.", "norm1.")] \
+        + [(f"dynamics.convs.{i}.", f"layers_seq.{i}.") for i in range(n_layers)] \
+        + [(f"dynamics.norms.{i}.", f"layers_seq.{n_layers + i}.") for i in range(n_layers)]
+
+
+def rename_prefixes(state_dict, prefix, pairs):
+    for src, dst in pairs:
+        for key in [key for key in state_dict if key.startswith(prefix + src)]:
+            state_dict[prefix + dst + key[len(prefix + src):]] = state_dict.pop(key)
+
+
+def save_checkpoint_layout(module, state_dict, prefix, local_metadata):
+    """State dict hook saving ODEfunc under the checkpoint keys of checkpoint_prefixes"""
+    if module.fused_time and isinstance(module.dynamics, torch.jit.ScriptModule):
+        # the compiled convs do not run the hooks of FusedConcatConv2d
+        for i in range(module.n_layers):
+            merge_time_weight(None, state_dict, f"{prefix}dynamics.convs.{i}.", None)
+    rename_prefixes(state_dict, prefix, checkpoint_prefixes(module.n_layers))
+
+
 class ODEfunc(nn.Module):
 
-    def __init__(self, dim, n_layers=3, sigma=0.1, noise_type="additive"):
+    def __init__(self, dim, n_layers=3, sigma=0.1, noise_type="additive", fused_time=True, conv="dense", groups=8, rank=64):
         super(ODEfunc, self).__init__()
-        self.norm1 = norm(dim)
-        self.relu = nn.ReLU(inplace=True)
-        self.layers = []
         self.norm = norm(dim)
-        for i in range(n_layers):
-            self.layers.append(
-                {
-                    "conv": ConcatConv2d(dim, dim, 3, 1, 1),
-                    "norm": norm(dim),
-                }
-            )
-        lyrs = [l["conv"] for l in self.layers] + [l["norm"] for l in self.layers]
-        self.layers_seq = torch.nn.Sequential(*lyrs)
+        if conv == "dense":
+            concat_conv = FusedConcatConv2d if fused_time else ConcatConv2d
+            convs = [concat_conv(dim, dim, 3, 1, 1) for _ in range(n_layers)]
+        else:
+            convs = [FactorisedConcatConv2d(dim, dim, 3, 1, 1, kind=conv, groups=groups, rank=rank) for _ in range(n_layers)]
+        self.n_layers = n_layers
+        self.fused_time = conv == "dense" and fused_time
+        self.dynamics = ODEDynamics(norm(dim), convs, [norm(dim) for _ in range(n_layers)])
+        self._register_state_dict_hook(save_checkpoint_layout)
         self.nfe = 0
+        self.nfe_limit = None
+        self.func_time = 0.
+        self.profile = False
+        self.autocast_dtype = None
         self.sigma = sigma
         self.noise_type = noise_type
 
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        rename_prefixes(state_dict, prefix, [(dst, src) for src, dst in checkpoint_prefixes(self.n_layers)])
+        if self.fused_time and isinstance(self.dynamics, torch.jit.ScriptModule):
+            for i in range(self.n_layers):
+                split_time_weight(state_dict, f"{prefix}dynamics.convs.{i}.")
+        super(ODEfunc, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys,
+                                                   unexpected_keys, error_msgs)
+
+    def script(self):
+        """
+        Evaluate the dynamics through a TorchScript compiled ODEDynamics, registered in place of
+        the Python one with the same parameters and checkpoint keys. The evaluation counting stays
+        in forward.
+        """
+        self.dynamics = torch.jit.script(self.dynamics)
+        return self
+
     def forward(self, t, x):
         self.nfe += 1
+        if self.nfe_limit is not None and self.nfe > self.nfe_limit:
+            raise NFEBudgetExceeded("ODE solve exceeded its function evaluation budget")
+        tic = time.perf_counter()
 
-        out = self.norm1(x)
-        for i in range(len(self.layers)):
-            out = self.relu(out)
-            out = self.layers[i]["conv"](t, out)
-            out = self.layers[i]["norm"](out)
-        
+        if self.autocast_dtype is None:
+            out = self.dynamics(t, x)
+        else:
+            # only the evaluation runs in low precision, the solver state and error estimate stay in x.dtype
+            with torch.autocast(x.device.type, dtype=self.autocast_dtype):
+                out = self.dynamics(t, x)
+            out = out.to(x.dtype)
+
+        if self.profile and out.is_cuda:
+            # the device time of every evaluation, at the cost of a host synchronisation per stage
+            torch.cuda.synchronize(out.device)
+        self.func_time += time.perf_counter() - tic
         return out 
 
+    def diffusion(self, x):
+        """
+        Diagonal noise g(x) of the stochastic dynamics dx = f(t, x) dt + g(x) dW and its derivative
+        dg/dx. Additive noise is a constant sigma, multiplicative noise is sigma * x.
+        """
+        if self.noise_type == "additive":
+            return self.sigma, 0.
+        if self.noise_type == "multiplicative":
+            return self.sigma * x, self.sigma
+        raise ValueError("ODE noise type must be one of {}, got {}".format(NOISE_TYPES, self.noise_type))
 
 
 
-class ODEBlock(nn.Module):
 
-    def __init__(self, odefunc, ode_time=1):
+class RegularisedODEfunc(nn.Module):
+    """
+    Augments the ODE state with the running integrals of the kinetic energy ||f||^2 and of the
+    Jacobian Frobenius norm ||df/dx||_F^2 (Hutchinson estimate e^T df/dx with a fixed noise e per
+    solve), both averaged over the feature elements of each sample. Smooth dynamics need fewer
+    solver steps, so penalising these integrals during training brings the NFE down.
+    """
+
+    def __init__(self, odefunc, jacobian=True):
+        super(RegularisedODEfunc, self).__init__()
+        self.odefunc = odefunc
+        self.jacobian = jacobian
+        self.noise = None
+
+    def forward(self, t, state):
+        x = state[0]
+        # the adjoint forward runs under no_grad, where x may require grad without having a graph
+        if not torch.is_grad_enabled() or not x.requires_grad:
+            x = x.detach().requires_grad_(True)
+        with torch.enable_grad():
+            dx = self.odefunc(t, x)
+            kinetic = dx.pow(2).flatten(1).mean(1)
+            if self.jacobian:
+                noise_jac = torch.autograd.grad(dx, x, self.noise, create_graph=True)[0]
+                jacobian = noise_jac.pow(2).flatten(1).mean(1)
+            else:
+                jacobian = torch.zeros_like(kinetic)
+        return dx, kinetic, jacobian
+
+
+class ODEBlock(nn.Module):
+    """
+    Integrates odefunc from 0 to ode_time
+
+    Args:
+        ode_time:
+            end time, or an increasing list of output times that are all obtained from a single
+            solve. forward returns the state at the last one unless all_horizons is set.
+        solver:
+            dict overriding DEFAULT_SOLVER. "method" is any torchdiffeq solver; the fixed step
+            ones take "n_steps" steps and the adaptive ones use "tol" and "max_num_steps".
+            When "max_nfe" is set and a solve needs more evaluations, it is abandoned and
+            redone with the fixed step "fallback" method in "fallback_steps" steps, so a
+            forward never costs more than max_nfe plus the fallback's evaluations.
+            "autocast" ("bfloat16", or "float16" on GPU) runs the ODE function evaluations under
+            autocast. The solver state and its error control stay in fp32. A "tol" below the
+            machine epsilon of the autocast dtype is raised to it, with a warning.
+        backprop:
+            "direct" backpropagates through the solver internals and keeps every stage,
+            "adjoint" solves the adjoint ODE backwards in time at "adjoint_tol" (defaults
+            to "tol") without storing the solver states, and "checkpointed" splits the interval
+            into "checkpoint_segments" segments that are recomputed during backward. The adjoint
+            is tested with euler, midpoint, rk4 and dopri5 in tests/test_ode_adjoint.py.
+        reg:
+            dict of "kinetic" and "jacobian" loss weights. When either is positive, training
+            forwards also integrate the RegularisedODEfunc terms, see pop_regularisation.
+
+    With solver "per_sample", dopri5 solves under direct backprop give every sample its own step
+    size (per_sample_dopri5) instead of stepping the whole batch at the size its hardest sample
+    needs. FewShotSeg encodes support and query slices as one batch, so this matters most when
+    they differ in difficulty.
+
+    With solver "equilibrium", inference forwards without gradients and with a single output time
+    look for the steady state f(ode_time, x) = 0 the trajectory settles to instead of integrating,
+    see solve_equilibrium. If it is not found within "eq_max_iter" iterations, the forward falls
+    back to the normal solve.
+
+    When solver "sde" is "euler_maruyama" or "milstein" and odefunc has an additive or
+    multiplicative noise_type with a sigma, the block integrates the stochastic dynamics instead,
+    see forward_sde.
+
+    With "warm_start", the step the controller proposes after the first accepted step of an adaptive
+    solve is remembered per input shape and train/eval mode and used as the first step of the next
+    solve of that kind, which skips the initial step size selection and the rejections of a poor
+    first guess. The proposal grows after an accurate first step and shrinks after rejections, so
+    the cached step follows the dynamics in both directions. Consecutive slices of a
+    volume and consecutive training iterations start from very similar states.
+
+    The ODEStats of the last forward are kept in self.stats.
+    """
+
+    def __init__(self, odefunc, ode_time=1, solver=None, backprop="direct", reg=None):
         super(ODEBlock, self).__init__()
         self.odefunc = odefunc
-        self.integration_time = torch.tensor([0, ode_time]).float()
-        self.tol = 1e-3
+        self.horizons = list(ode_time) if isinstance(ode_time, (list, tuple)) else [ode_time]
+        if any(t1 <= t0 for t0, t1 in zip([0] + self.horizons, self.horizons)):
+            raise ValueError("ODE output times must be positive and increasing, got {}".format(ode_time))
+        self.integration_time = torch.tensor([0] + self.horizons).float()
+        solver = dict(DEFAULT_SOLVER, **(solver or {}))
+        self.method = solver["method"]
+        self.tol = solver["tol"]
+        self.autocast = solver["autocast"]
+        odefunc.profile = solver["profile"]
+        if self.autocast is not None:
+            odefunc.autocast_dtype = getattr(torch, self.autocast)
+            # below the machine epsilon of the autocast dtype the error estimate only measures rounding noise
+            eps = torch.finfo(odefunc.autocast_dtype).eps
+            if self.tol < eps:
+                logging.warning("ODE tol %.1e is below the machine epsilon of %s, solving at tol %.1e instead",
+                                self.tol, self.autocast, eps)
+                self.tol = eps
+        self.n_steps = solver["n_steps"]
+        self.max_num_steps = solver["max_num_steps"]
+        self.max_nfe = solver["max_nfe"]
+        self.fallback = solver["fallback"]
+        self.fallback_steps = solver["fallback_steps"]
+        self.adjoint_tol = solver["adjoint_tol"] if solver["adjoint_tol"] is not None else self.tol
+        self.checkpoint_segments = solver["checkpoint_segments"]
+        self.warm_start = solver["warm_start"]
+        self.step_cache = {}
+        self.backprop = backprop
+        if backprop not in BACKPROP_MODES:
+            raise ValueError("ODE backprop mode must be one of {}".format(BACKPROP_MODES))
+        if self.fallback is not None and self.fallback not in FIXED_GRID_SOLVERS:
+            raise ValueError("ODE fallback solver must be one of {}".format(FIXED_GRID_SOLVERS))
+        self.stats = None
+        self.reg_weights = dict({"kinetic": 0., "jacobian": 0.}, **(reg or {}))
+        self.reg_func = None
+        if any(weight > 0 for weight in self.reg_weights.values()):
+            self.reg_func = RegularisedODEfunc(odefunc, jacobian=self.reg_weights["jacobian"] > 0)
+        self.reg_terms = {}
+        self.sde = solver["sde"]
+        self.sde_samples = solver["sde_samples"]
+        if self.sde is not None and self.sde not in SDE_SOLVERS:
+            raise ValueError("ODE sde solver must be one of {}".format(SDE_SOLVERS))
+        self.variance = None
+        self.per_sample = solver["per_sample"]
+        self.equilibrium = solver["equilibrium"]
+        self.eq_tol = solver["eq_tol"]
+        self.eq_max_iter = solver["eq_max_iter"]
+        self.eq_memory = solver["eq_memory"]
+        self.eq_step = solver["eq_step"]
 
-    def forward(self, x):
+    @property
+    def stochastic(self):
+        return self.sde is not None and self.odefunc.noise_type in NOISE_TYPES and bool(self.odefunc.sigma)
+
+    def dynamics(self, y):
+        return self.reg_func if isinstance(y, tuple) else self.odefunc
+
+    def solver_options(self, method, n_steps, stats=None, first_step=None):
+        if method in FIXED_GRID_SOLVERS:
+            return method, {"grid_constructor": uniform_grid(n_steps)}
+        options = {}
+        if self.max_num_steps is not None:
+            options["max_num_steps"] = self.max_num_steps
+        if first_step is not None:
+            options["first_step"] = first_step
+        if stats is not None and method in TRACKED_SOLVERS:
+            method = TRACKED_SOLVERS[method]
+            options["stats"] = stats
+        return method, options
+
+    def integrate(self, y0, method, n_steps, stats, first_step=None):
+        t = self.integration_time
+        x = y0[0] if isinstance(y0, tuple) else y0
+        if method in FIXED_GRID_SOLVERS:
+            stats.accepted_steps += n_steps
+            stats.first_step = stats.final_step = float(t[-1] - t[0]) / n_steps
+        if self.per_sample and method == "dopri5" and not isinstance(y0, tuple) \
+                and not (torch.is_grad_enabled() and self.backprop != "direct"):
+            return per_sample_dopri5(self.odefunc, y0, t, self.tol, self.tol, first_step, self.max_num_steps, stats)
+        if torch.is_grad_enabled() and self.backprop == "adjoint":
+            solver_method, options = self.solver_options(method, n_steps, stats, first_step)
+            _, adjoint_options = self.solver_options(method, n_steps)
+            return odeint_adjoint(self.dynamics(y0), y0, t, rtol=self.tol, atol=self.tol,
+                                  method=solver_method, options=options,
+                                  adjoint_rtol=self.adjoint_tol, adjoint_atol=self.adjoint_tol,
+                                  adjoint_method=method, adjoint_options=adjoint_options)
+        # checkpoint only propagates gradients to the parameters through an input requiring grad
+        if torch.is_grad_enabled() and self.backprop == "checkpointed" and x.requires_grad:
+            return self.integrate_checkpointed(y0, method, n_steps, stats, first_step)
+        return self.solve(y0, t, method, n_steps, stats, first_step)
+
+    def solve(self, y0, t, method, n_steps, stats=None, first_step=None):
+        method, options = self.solver_options(method, n_steps, stats, first_step)
+        return odeint(self.dynamics(y0), y0, t, rtol=self.tol, atol=self.tol, method=method, options=options)
+
+    def integrate_checkpointed(self, y0, method, n_steps, stats, first_step=None):
+        t = self.integration_time
+        if len(t) > 2:
+            # one segment per output interval
+            bounds = t
+        else:
+            bounds = t[0] + (t[-1] - t[0]) * torch.linspace(0, 1, self.checkpoint_segments + 1, dtype=t.dtype, device=t.device)
+        n_segments = len(bounds) - 1
+        segment_steps = max(1, n_steps // n_segments)
+
+        def solve_segment(segment_t, segment_first_step, *y):
+            # the first call runs under no_grad, the recomputation in backward must not be recorded
+            segment_stats = None if torch.is_grad_enabled() else stats
+            y = y if len(y) > 1 else y[0]
+            return last_state(self.solve(y, segment_t, method, segment_steps, segment_stats, segment_first_step))
+
+        states = [y0]
+        for i in range(n_segments):
+            y = states[-1] if isinstance(y0, tuple) else (states[-1],)
+            states.append(checkpoint(solve_segment, bounds[i:i + 2], first_step if i == 0 else None, *y))
+        if len(t) > 2:
+            return stack_states(states)
+        return stack_states([y0, states[-1]])
+
+    def solve_equilibrium(self, x):
+        """
+        Steady state of the dynamics at the last output time, found as the fixed point of the
+        damped pseudo time step y <- y + eq_step * f(ode_time, y) from x with Anderson
+        acceleration. Returns None if some sample has not converged to eq_tol.
+        """
+        t = self.integration_time[-1]
+
+        def step(y):
+            return y + self.eq_step * self.odefunc(t, y.view_as(x)).flatten(1)
+
+        y, residual = anderson(step, x.flatten(1), self.eq_memory, self.eq_max_iter, self.eq_tol)
+        if not torch.isfinite(residual).all() or residual.max() > self.eq_tol:
+            return None
+        return y.view_as(x)
+
+    def pop_regularisation(self):
+        """
+        Weighted regularisation loss and the raw integrals of the training forwards since the
+        last call. Call it once per training step, the terms hold on to the forward graphs.
+        """
+        terms, self.reg_terms = self.reg_terms, {}
+        loss = sum(self.reg_weights[key] * value for key, value in terms.items())
+        return loss, terms
+
+    def reset_step_cache(self):
+        self.step_cache = {}
+
+    def track_backward(self, x, out, stats):
+        """Attribute the ODE evaluations made while backpropagating from out to x to stats"""
+        start = {}
+
+        def on_output_grad(grad):
+            start["nfe"], start["time"] = self.odefunc.nfe, self.odefunc.func_time
+
+        def on_input_grad(grad):
+            if start:
+                stats.nfe_backward += self.odefunc.nfe - start["nfe"]
+                stats.func_time_backward += self.odefunc.func_time - start["time"]
+
+        out.register_hook(on_output_grad)
+        x.register_hook(on_input_grad)
+
+    def forward_sde(self, x, stats):
+        """
+        Integrates the Ito SDE on the fixed "n_steps" grid, with the sde_samples Monte-Carlo noise
+        paths stacked along the batch dimension so that every step is a single odefunc call.
+        Milstein adds the 0.5 * g * dg/dx * (dW^2 - dt) correction, which vanishes for additive
+        noise. Returns the mean and the variance over the paths at every output time.
+        """
+        t = self.integration_time
+        grid = uniform_grid(self.n_steps)(self.odefunc, x, t)
+        outputs = set(torch.searchsorted(grid, t[1:]).tolist())
+        n_samples = self.sde_samples
+        y = x.repeat(n_samples, *[1] * (x.dim() - 1))
+        outs = []
+        for i in range(len(grid) - 1):
+            dt = grid[i + 1] - grid[i]
+            dw = torch.randn_like(y) * dt.sqrt()
+            g, dg = self.odefunc.diffusion(y)
+            dy = self.odefunc(grid[i], y) * dt + g * dw
+            if self.sde == "milstein" and self.odefunc.noise_type != "additive":
+                dy = dy + 0.5 * g * dg * (dw.pow(2) - dt)
+            y = y + dy
+            if i + 1 in outputs:
+                outs.append(y.view(n_samples, *x.shape))
+        stats.accepted_steps = len(grid) - 1
+        stats.first_step = float(grid[1] - grid[0])
+        stats.final_step = float(grid[-1] - grid[-2])
+        out = torch.stack(outs)
+        return out.mean(1), out.var(1, unbiased=n_samples > 1)
+
+    def forward(self, x, all_horizons=False):
+        """
+        Returns the state at the last output time, or at every output time if all_horizons. In
+        the stochastic mode this is the Monte-Carlo mean, and the matching variance is kept in
+        self.variance.
+        """
         self.integration_time = self.integration_time.type_as(x)
-        out = odeint(self.odefunc, x, self.integration_time, rtol=self.tol, atol=self.tol)
-        return out[1]
+        stats = ODEStats()
+        if self.stochastic:
+            nfe_start, time_start = self.odefunc.nfe, self.odefunc.func_time
+            tic = time.perf_counter()
+            out, variance = self.forward_sde(x, stats)
+            out, self.variance = (out, variance) if all_horizons else (out[-1], variance[-1])
+            stats.nfe_forward = self.odefunc.nfe - nfe_start
+            stats.func_time = self.odefunc.func_time - time_start
+            stats.wall_time = time.perf_counter() - tic
+            if out.requires_grad and x.requires_grad:
+                self.track_backward(x, out, stats)
+            self.stats = stats
+            return out
+        cache_key = (tuple(x.shape), self.training)
+        first_step = self.step_cache.get(cache_key) if self.warm_start else None
+        stats.warm_start = first_step is not None
+        y0 = x
+        regularise = self.reg_func is not None and self.training and torch.is_grad_enabled()
+        if regularise:
+            self.reg_func.noise = torch.randn_like(x)
+            y0 = (x, x.new_zeros(x.shape[0]), x.new_zeros(x.shape[0]))
+        nfe_start, time_start = self.odefunc.nfe, self.odefunc.func_time
+        tic = time.perf_counter()
+        if self.equilibrium and not self.training and not torch.is_grad_enabled() and not all_horizons:
+            steady_state = self.solve_equilibrium(x)
+            stats.equilibrium = steady_state is not None
+        if stats.equilibrium:
+            out = torch.stack([x, steady_state])
+        else:
+            if self.max_nfe is not None:
+                self.odefunc.nfe_limit = self.odefunc.nfe + self.max_nfe
+            try:
+                out = self.integrate(y0, self.method, self.n_steps, stats, first_step)
+            except NFEBudgetExceeded:
+                if self.fallback is None:
+                    raise
+                self.odefunc.nfe_limit = None
+                stats.fallback = True
+                out = self.integrate(y0, self.fallback, self.fallback_steps, stats)
+            finally:
+                self.odefunc.nfe_limit = None
+        if regularise:
+            out, kinetic, jacobian = out
+            for key, value in [("kinetic", kinetic[-1].mean()), ("jacobian", jacobian[-1].mean())]:
+                self.reg_terms[key] = self.reg_terms.get(key, 0) + value
+        out = out[1:] if all_horizons else out[-1]
+        stats.nfe_forward = self.odefunc.nfe - nfe_start
+        stats.func_time = self.odefunc.func_time - time_start
+        stats.wall_time = time.perf_counter() - tic
+        if self.warm_start and self.method not in FIXED_GRID_SOLVERS and not stats.fallback \
+                and stats.accepted_steps > 0:
+            self.step_cache[cache_key] = stats.first_step if math.isnan(stats.next_step) else stats.next_step
+        if out.requires_grad and x.requires_grad:
+            self.track_backward(x, out, stats)
+        self.stats = stats
+        return out
 
     @property
     def nfe(self):
@@ -106,18 +912,43 @@ class ODEBlock(nn.Module):
 
 
 class ODENet(nn.Module):
-    def __init__(self, in_channels, pretrained_path=None, ode_layers=3, ode_time=1, noise_type=None, sigma=None):
+    """
+    ODEBlock on the encoder features
+
+    With pool > 1, the ODE is integrated on features reduced pool times in each direction by a
+    learned depthwise strided convolution (initialised to average pooling), which cuts the cost
+    of every evaluation by pool^2. The change the ODE makes to the coarse features is upsampled,
+    passed through a learned 1x1 projection (initialised to the identity) and added to the full
+    resolution input, so the detail the integration does not see is kept.
+    """
+    def __init__(self, in_channels, pretrained_path=None, ode_layers=3, ode_time=1, noise_type=None, sigma=None, solver=None, backprop="direct", reg=None, script=False, conv="dense", conv_groups=8, conv_rank=64, pool=1):
         super(ODENet, self).__init__()
-        self.ode = ODEBlock(ODEfunc(in_channels, n_layers=ode_layers, noise_type=noise_type, sigma=sigma), ode_time=ode_time)
-
-    def forward(self, x):
-        return self.ode(x)
+        odefunc = ODEfunc(in_channels, n_layers=ode_layers, noise_type=noise_type, sigma=sigma, conv=conv, groups=conv_groups, rank=conv_rank)
+        if script:
+            odefunc.script()
+        self.ode = ODEBlock(odefunc, ode_time=ode_time, solver=solver, backprop=backprop, reg=reg)
+        self.pool = pool
+        if pool > 1:
+            self.down = nn.Conv2d(in_channels, in_channels, pool, stride=pool, groups=in_channels, bias=False)
+            self.up = nn.Conv2d(in_channels, in_channels, 1)
+            with torch.no_grad():
+                self.down.weight.fill_(1. / pool ** 2)
+                self.up.weight.copy_(torch.eye(in_channels).view(in_channels, in_channels, 1, 1))
+                self.up.bias.zero_()
+
+    def forward(self, x, all_horizons=False):
+        if self.pool == 1:
+            return self.ode(x, all_horizons=all_horizons)
+        coarse = self.down(x)
+        delta = self.ode(coarse, all_horizons=all_horizons) - coarse
+        shape = delta.shape
+        delta = F.interpolate(delta.reshape(-1, *shape[-3:]), size=x.shape[-2:], mode="bilinear", align_corners=False)
+        return x + self.up(delta).view(*shape[:-2], *x.shape[-2:])
 
 
 
 class FewShotSegOde(FewShotSeg):
-    def __init__(self, in_channels=1, pretrained_path=None, pretrained_ode=False, ode_layers=3, ode_time=1, noise_type="None", sigma=None):
-        super().__init__(in_channels=in_channels, pretrained_path=pretrained_path)
+    def __init__(self, in_channels=1, pretrained_path=None, pretrained_ode=False, ode_layers=3, ode_time=1, noise_type="None", sigma=None, ode_solver=None, ode_backprop="direct", ode_reg=None, ode_script=False, ode_conv="dense", ode_conv_groups=8, ode_conv_rank=64, ode_pool=1, proto_pooling="upsample", low_res_logits=False):
         ode_weights = pretrained_path if pretrained_ode else None
         # Encoder
         if ode_layers == 5:
@@ -126,11 +957,24 @@ class FewShotSegOde(FewShotSeg):
             last_2_layers = 2
         else:
             last_2_layers = 3
-        self.encoder = nn.Sequential(
+        encoder = nn.Sequential(
             OrderedDict(
                 [
-                    ('backbone', Encoder(in_channels, self.pretrained_path, rem_last_layer=True, pretrained_ode=pretrained_ode, last_2_layers=last_2_layers)),
-                    ('ode', ODENet(512, pretrained_path=ode_weights, ode_layers=ode_layers, ode_time=ode_time, noise_type=noise_type, sigma=sigma)), 
+                    ('backbone', Encoder(in_channels, pretrained_path, rem_last_layer=True, pretrained_ode=pretrained_ode, last_2_layers=last_2_layers)),
+                    ('ode', ODENet(512, pretrained_path=ode_weights, ode_layers=ode_layers, ode_time=ode_time, noise_type=noise_type, sigma=sigma, solver=ode_solver, backprop=ode_backprop, reg=ode_reg, script=ode_script, conv=ode_conv, conv_groups=ode_conv_groups, conv_rank=ode_conv_rank, pool=ode_pool)), 
                 ]
             )
-        )
\ No newline at end of file
+        )
+        super().__init__(in_channels=in_channels, pretrained_path=pretrained_path, pooling=proto_pooling, low_res_logits=low_res_logits, encoder=encoder)
+
+    def forward_horizons(self, supp_imgs, fore_mask, back_mask, qry_imgs, factor=1, return_feats=False):
+        """
+        Segment the queries with the ODE features at every output time of ode_time, all taken
+        from a single integration. Takes the arguments of forward and returns a list with its
+        outputs for each output time, in increasing order.
+        """
+        self.factor = factor
+        fts = self.encoder.backbone(self.concat_images(supp_imgs, qry_imgs))
+        horizon_fts = self.encoder.ode(fts, all_horizons=True)
+        return [self.segment(img_fts, supp_imgs, fore_mask, qry_imgs, return_feats=return_feats)
+                for img_fts in horizon_fts]
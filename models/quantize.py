@@ -0,0 +1,109 @@
+"""
+Static int8 post-training quantisation of FewShotSegOde for CPU inference
+"""
+import torch
+import torch.nn as nn
+import torch.quantization as tq
+
+from .ode import FactorisedConcatConv2d
+
+
+def quant_engine():
+    """fbgemm on x86, qnnpack elsewhere"""
+    return "fbgemm" if "fbgemm" in torch.backends.quantized.supported_engines else "qnnpack"
+
+
+def int8_qconfig(engine):
+    """Histogram observed activations and symmetric int8 weights with a scale per output channel"""
+    # fbgemm accumulates in 16 bits before its VNNI path, so it needs 7 bit activations
+    return tq.QConfig(activation=tq.HistogramObserver.with_args(reduce_range=engine == "fbgemm"),
+                      weight=tq.default_per_channel_weight_observer)
+
+
+class QuantisedConv(tq.QuantWrapper):
+    """QuantWrapper of the conv of a time conditioned ODE conv, which keeps its geometry visible to time_map"""
+    stride = property(lambda self: self.module.stride)
+    padding = property(lambda self: self.module.padding)
+    dilation = property(lambda self: self.module.dilation)
+
+
+def conv_relu_pairs(module):
+    """Names of the (Conv2d, ReLU) pairs that follow each other in the nn.Sequential modules of module"""
+    pairs = []
+    for name, seq in module.named_modules():
+        if not isinstance(seq, nn.Sequential):
+            continue
+        children = list(seq.named_children())
+        for (conv_name, conv), (relu_name, relu) in zip(children, children[1:]):
+            if isinstance(conv, nn.Conv2d) and isinstance(relu, nn.ReLU):
+                prefix = f"{name}." if name else ""
+                pairs.append([prefix + conv_name, prefix + relu_name])
+    return pairs
+
+
+def wrap_ode_convs(odefunc):
+    """
+    Wrap the convolutions of the ODE dynamics in quantise / dequantise pairs. The norms, the relu
+    and the time kernel stay in fp32, so the solver state and its error control are unchanged and
+    only the dense convolutions of every evaluation run in int8.
+    """
+    if isinstance(odefunc.dynamics, torch.jit.ScriptModule):
+        raise ValueError("the scripted ODE dynamics can not be quantised, build the model with ode_script=False")
+    wrappers = []
+    for conv in odefunc.dynamics.convs:
+        if isinstance(conv, FactorisedConcatConv2d):
+            conv.body = tq.QuantWrapper(conv.body)
+            wrappers.append(conv.body)
+        else:
+            conv._layer = QuantisedConv(conv._layer)
+            wrappers.append(conv._layer)
+    return wrappers
+
+
+def prepare_int8(model, ode=True, engine=None):
+    """
+    Fuse the conv + relu pairs of the encoder backbone and insert the observers of a static int8
+    quantisation, in place. The backbone runs in int8 from its input to its output features, and
+    with ode the convolutions of the ODE dynamics as well. Run calibration episodes through the
+    model, then convert it with tq.convert.
+    """
+    engine = engine or quant_engine()
+    torch.backends.quantized.engine = engine
+    qconfig = int8_qconfig(engine)
+    model.eval()
+    backbone = model.encoder.backbone
+    tq.fuse_modules(backbone, conv_relu_pairs(backbone), inplace=True)
+    backbone.features = tq.QuantWrapper(backbone.features)
+    wrappers = [backbone.features]
+    if ode:
+        wrappers += wrap_ode_convs(model.encoder.ode.ode.odefunc)
+    for wrapper in wrappers:
+        wrapper.qconfig = qconfig
+    tq.prepare(model, inplace=True)
+    return model
+
+
+def quantize_int8(model, calibrate, ode=True, engine=None):
+    """Static int8 quantisation of model, in place, with the observers fed by calibrate(model)"""
+    prepare_int8(model, ode=ode, engine=engine)
+    with torch.no_grad():
+        calibrate(model)
+    return tq.convert(model, inplace=True)
+
+
+def save_int8(model, path, ode=True, snapshot=None):
+    torch.save({
+        "state_dict": model.state_dict(),
+        "ode": ode,
+        "engine": torch.backends.quantized.engine,
+        "snapshot": snapshot,
+    }, path)
+
+
+def load_int8(model, path):
+    """Load a model written by save_int8 into the float model it was quantised from, built with the same arguments"""
+    checkpoint = torch.load(path, map_location="cpu")
+    prepare_int8(model, ode=checkpoint["ode"], engine=checkpoint["engine"])
+    tq.convert(model, inplace=True)
+    model.load_state_dict(checkpoint["state_dict"])
+    return model
@@ -5,6 +5,8 @@ Encoder for few shot segmentation (VGG16)
 import torch
 import torch.nn as nn
 
+from .checkpoint import VGG16_CONVS, load_checkpoint, load_mapped, vgg16_key_map
+
 class Encoder(nn.Module):
     """
     Encoder for few shot segmentation
@@ -77,21 +79,12 @@ class Encoder(nn.Module):
                 torch.nn.init.kaiming_normal_(m.weight, nonlinearity='relu')
 
         if self.pretrained_path is not None:
-            dic = torch.load(self.pretrained_path, map_location='cpu')
-            keys = list(dic.keys())
-            new_dic = self.state_dict()
-            new_keys = list(new_dic.keys())
-
-            for i in range(4,26):
-                try:
-                    new_dic[new_keys[i]] = dic[keys[i]]
-                except IndexError:
-                    if not self.pretrained_ode:
-                        print("VGG model weight {} not initialised".format(i))
-                        continue
-                    elif self.pretrained_ode and i<20:
-                        print("VGG model weight {} not initialised".format(i))
-                        continue
-                    
-
-            self.load_state_dict(new_dic)
+            # torchvision vgg16 weights from the second block on, copied by parameter name
+            key_map = vgg16_key_map(self)
+            missing = load_mapped(self, load_checkpoint(self.pretrained_path), key_map)
+            if missing:
+                raise KeyError("{} is not a torchvision vgg16 checkpoint, it misses {}".format(self.pretrained_path, missing))
+            n_convs = len(key_map) // 2 + 2
+            for i in range(n_convs, len(VGG16_CONVS)):
+                if not self.pretrained_ode or i < 10:
+                    print("VGG model weight features.{} not initialised".format(VGG16_CONVS[i]))
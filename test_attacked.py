@@ -1,4 +1,6 @@
 """Evaluation Script"""
+import time
+START_TIME = time.perf_counter()
 import os
 import shutil
 import pdb
@@ -7,13 +9,17 @@ import numpy as np
 import torch
 import torch.optim
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.utils.data import DataLoader
 import torch.backends.cudnn as cudnn
 from torchvision.utils import make_grid
 
-from models.fewshot import FewShotSeg
+from models.fewshot import FewShotSeg, predict_labels
 from models.ode import FewShotSegOde
-from util.utils import set_seed, CLASS_LABELS, get_bbox, date
+from models.checkpoint import load_snapshot
+from models.quantize import load_int8
+from dataloaders_medical.support_index import SupportIndex, build_support_index, embed_slices
+from util.utils import set_seed, peak_rss_mb, CLASS_LABELS, get_bbox, date
 from test_config import ex
 
 from tensorboardX import SummaryWriter
@@ -52,6 +58,49 @@ def overlay_color(img, mask, label, scale=50):
     masked = img_3ch+mask.float()*scale+label.float()*scale
     return [masked]
 
+def test_organs(model, dataset, _config, _run, device):
+    """
+    Clean N-way test over the organs of _config['targets']: every query slice is segmented for
+    all organs by a single model pass, and the dice of every organ is reported per subject.
+    """
+    targets = _config["targets"]
+    preds = {subj_idx: [] for subj_idx in range(len(dataset.get_cnts()))}
+    labels = {subj_idx: [] for subj_idx in preds}
+    latencies = []
+    testloader = DataLoader(dataset=dataset, batch_size=1, shuffle=False, pin_memory=False, drop_last=False)
+    for i, sample_test in enumerate(tqdm(testloader)):
+        subj_idx, _ = dataset.get_test_subj_idx(i)
+        s_x = sample_test['s_x'].to(device).squeeze(3)  # [B, Way, Support, 1, 256, 256]
+        s_y = sample_test['s_y'].to(device).squeeze(3).squeeze(3)  # [B, Way, Support, 256, 256]
+        q_x = sample_test['q_x'].to(device).squeeze(1)  # [B, 1, 256, 256]
+        q_y = sample_test['q_y'].squeeze(1).squeeze(1).long()  # [B, 256, 256], organ w labelled w + 1
+        tic = time.perf_counter()
+        q_yhat = predict_labels(model.predict(s_x, s_y, q_x), q_y.shape[-2:])
+        preds[subj_idx].append(q_yhat.cpu().numpy())
+        latencies.append(time.perf_counter() - tic)
+        labels[subj_idx].append(q_y.numpy())
+
+    organ_dices = {target: [] for target in targets}
+    for subj_idx in preds:
+        pred_arr = np.concatenate(preds[subj_idx], axis=0)
+        label_arr = np.concatenate(labels[subj_idx], axis=0)
+        for way, target in enumerate(targets):
+            pred_organ, label_organ = pred_arr == way + 1, label_arr == way + 1
+            organ_dices[target].append(np.sum(pred_organ * label_organ) * 2.0 / (np.sum(pred_organ) + np.sum(label_organ)))
+
+    with open("test_results_adv_all.log", 'a') as f:
+        f.write("\n" + _config["log_name"])
+        for target, dices in organ_dices.items():
+            print(f"target {target} : mean dice score : {np.mean(dices):.4f} \n dice similarities : {dices}")
+            _run.log_scalar(f'dice_score.target_{target}', np.mean(dices))
+            f.write(" | target {} dice : {:.4f}".format(target, np.mean(dices)))
+        latency = 1000 * np.mean(latencies)
+        print(f"model latency per query slice : {latency:.1f} ms on {device.type}{' (int8)' if _config['int8'] else ''}")
+        _run.log_scalar('latency_ms', latency)
+        f.write(" | Latency : {:.1f} ms".format(latency))
+        f.write("\n" + "="*60)
+    return organ_dices
+
 @ex.automain
 def main(_run, _config, _log):
     for source_file, _ in _run.experiment_info['sources']:
@@ -61,21 +110,36 @@ def main(_run, _config, _log):
     shutil.rmtree(f'{_run.observers[0].basedir}/_sources')
 
     set_seed(_config['seed'])
-    cudnn.enabled = True
-    cudnn.benchmark = True
-    torch.cuda.set_device(device=_config['gpu_id'])
+    # int8 kernels only run on CPU
+    device = torch.device('cpu') if _config['cpu'] or _config['int8'] else torch.device('cuda', _config['gpu_id'])
+    if device.type == 'cuda':
+        cudnn.enabled = True
+        cudnn.benchmark = True
+        torch.cuda.set_device(device=_config['gpu_id'])
     torch.set_num_threads(1)
 
 
     _log.info('###### Create model ######')
+    # the snapshot holds every weight, so the ImageNet VGG weights are only loaded without one
+    init_path = _config['path']['init_path'] if _config['notrain'] and not _config['int8'] else None
+    # features and predictions depend on the weights actually tested
+    weights = _config['int8'] or _config['snapshot']
     if _config["use_ode"]:
-        model_orig = FewShotSegOde(pretrained_path=_config['path']['init_path'], pretrained_ode=_config["pretrain_ode"], ode_layers=_config["ode_layers"], ode_time=_config["ode_time"], )
+        model_orig = FewShotSegOde(pretrained_path=init_path, pretrained_ode=_config["pretrain_ode"], ode_layers=_config["ode_layers"], ode_time=_config["ode_time"], noise_type=_config["feat_noise_type"], sigma=_config["gaussian_std"], ode_solver=_config["ode_solver"], ode_backprop=_config["ode_backprop"], ode_script=_config["ode_script"], ode_conv=_config["ode_conv"], ode_conv_groups=_config["ode_conv_groups"], ode_conv_rank=_config["ode_conv_rank"], ode_pool=_config["ode_pool"], proto_pooling=_config["proto_pooling"], low_res_logits=_config["low_res_logits"])
+    else:
+        model_orig = FewShotSeg(pretrained_path=init_path, cfg=_config['model'])
+    if _config['int8']:
+        if not _config["use_ode"] or _config["attack"].upper() not in ("NONE", "CLEAN"):
+            raise ValueError("int8 tests a FewShotSegOde clean, the int8 model has no gradients to attack")
+        load_int8(model_orig, _config['int8'])
+    elif not _config['notrain']:
+        load_snapshot(model_orig, _config['snapshot'])
+    if device.type == 'cuda':
+        model = nn.DataParallel(model_orig.cuda(), device_ids=[_config['gpu_id'],])
     else:
-        model_orig = FewShotSeg(pretrained_path=_config['path']['init_path'], cfg=_config['model'])
-    model = nn.DataParallel(model_orig.cuda(), device_ids=[_config['gpu_id'],])
-    if not _config['notrain']:
-        model.load_state_dict(torch.load(_config['snapshot'], map_location='cpu'))
+        model = model_orig
     model.eval()
+    model_orig.prepare_inference()
     print("no. of paramerters", sum(p.numel() for p in model.parameters()))
 
 
@@ -86,12 +150,31 @@ def main(_run, _config, _log):
     make_data = meta_data
     max_label = 1
 
+    if _config["targets"]:
+        if not _config["internal_test"] or _config["attack"].upper() not in ("NONE", "CLEAN"):
+            raise ValueError("the N-way test over targets only runs clean on the internal test sets")
+        val_dataset, ts_dataset = multi_organ_data(_config)
+        return test_organs(model_orig, ts_dataset if _config["dataset_mode"] == "test" else val_dataset, _config, _run, device)
+
     tr_dataset, val_dataset, ts_dataset = make_data(_config)
     if _config["dataset_mode"] == "test":
         used_dataset = ts_dataset
     else:
         used_dataset = val_dataset
 
+    if _config["support_index"]:
+        def embed(img):
+            with torch.no_grad():
+                return embed_slices(model_orig.encoder.backbone, img.to(device))[0].cpu()
+
+        index = SupportIndex.load(_config["support_index"]) if os.path.exists(_config["support_index"]) else None
+        if index is None or not index.matches(used_dataset, weights):
+            _log.info('###### Build support index ######')
+            index = build_support_index(used_dataset, model_orig.encoder.backbone, n_lists=_config["support_index_lists"],
+                                        snapshot=weights, device=device)
+            index.save(_config["support_index"])
+        used_dataset.set_support_index(index, embed, n_probe=_config["support_index_probe"])
+
     testloader = DataLoader(
         dataset=used_dataset,
         batch_size=1,
@@ -107,6 +190,10 @@ def main(_run, _config, _log):
         board_name = f'board/test_{_config["board"]}_{date()}'
         writer = SummaryWriter(board_name)
 
+    startup_time, startup_rss = time.perf_counter() - START_TIME, peak_rss_mb()
+    _log.info(f'startup : {startup_time:.1f}s, peak RSS : {startup_rss:.0f} MB')
+    _run.log_scalar('startup.time', startup_time)
+    _run.log_scalar('startup.peak_rss_mb', startup_rss)
     _log.info('###### Testing begins ######')
     # metric = Metric(max_label=max_label, n_runs=_config['n_runs'])
     img_cnt = 0
@@ -136,7 +223,11 @@ def main(_run, _config, _log):
                 s_y_fgs = [[s_y_fg[:,shot, ...] for shot in range(_config["n_shot"])]]
                 s_y_bgs = [[s_y_bg[:,shot, ...] for shot in range(_config["n_shot"])]]
                 q_xs = [q_x]
-                return model(s_xs, s_y_fgs, s_y_bgs, q_xs)[0]
+                logits = model(s_xs, s_y_fgs, s_y_bgs, q_xs)[0]
+                if _config["low_res_logits"]:
+                    # the attacks score the logits against full resolution labels
+                    logits = F.interpolate(logits, size=q_x.shape[-2:], mode='bilinear')
+                return logits
             return fun
         class wrapperModel(torch.nn.Module):
             def __init__(self, model):
@@ -180,7 +271,7 @@ def main(_run, _config, _log):
             x = x.detach()
         elif _config["attack"].upper() == "DAG":
             y = y.view(-1, y.shape[-2], y.shape[-1]).to(torch.long)
-            tar = torch.randint(0, 2, y.shape).cuda().to(torch.float)
+            tar = torch.randint(0, 2, y.shape).to(device).to(torch.float)
             tar.requires_grad_()
             x = DAG(wrapperModel(model_orig), x, y, tar, gamma=_config["attack_eps"])
             x = x[0]
@@ -197,11 +288,41 @@ def main(_run, _config, _log):
     for subj_idx in range(len(used_dataset.get_cnts())):
         saves[subj_idx] = []
 
+    # with a list of ode_time values, every output time is evaluated from the same ODE solve
+    horizons = list(_config["ode_time"]) if _config["use_ode"] and isinstance(_config["ode_time"], (list, tuple)) else []
+    horizon_preds = [{subj_idx: [] for subj_idx in saves} for _ in horizons]
+    # with the equilibrium mode, every slice is also predicted with the exact solve to report the drift
+    equilibrium = _config["use_ode"] and _config["ode_solver"]["equilibrium"] and not horizons
+    exact_preds = {subj_idx: [] for subj_idx in saves}
+    exact_nfe = []
+    # the support volume is fixed, so its slices are encoded once and reused by every query slice.
+    # An attacked support differs for every query, so it is always encoded again.
+    support_cache = _config["support_cache"] and _config["to_attack"] != "s" and not horizons
+    support_fts = {}
+    cache_hits = 0
+
+    def encode_support(s_xs, s_fnames):
+        nonlocal cache_hits
+        fts = []
+        # the support features of the exact solve and of the equilibrium search differ
+        solve = equilibrium and model_orig.encoder.ode.ode.equilibrium
+        for shot, s_x_shot in enumerate(s_xs[0]):
+            for b in range(s_x_shot.shape[0]):
+                key = (weights, s_fnames[shot][0][b], solve)
+                if key in support_fts:
+                    cache_hits += 1
+                else:
+                    support_fts[key] = model_orig.encode_support([[s_x_shot[b:b+1]]])
+                fts.append(support_fts[key])
+        return torch.cat(fts, dim=0)
+
     
     loss_valid = 0
     batch_i = 0 # use only 1 batch size for testing
     printed = False
     all_prototypes = []
+    all_ode_stats = []
+    latencies = []
     for i, sample_test in enumerate(tqdm(testloader)): # even for upward, down for downward
         # with open('query_support.txt', 'a') as f:
         #     f.write("\nQuery Set: " + str(sample_test['q_fname']))
@@ -217,17 +338,17 @@ def main(_run, _config, _log):
         # print(fnames)
         
 
-        s_x_orig = sample_test['s_x'].cuda()  # [B, Support, slice_num=1, 1, 256, 256]
+        s_x_orig = sample_test['s_x'].to(device)  # [B, Support, slice_num=1, 1, 256, 256]
         s_x = s_x_orig.squeeze(2)  # [B, Support, 1, 256, 256]
-        s_y_fg_orig = sample_test['s_y'].cuda()  # [B, Support, slice_num, 1, 256, 256]
+        s_y_fg_orig = sample_test['s_y'].to(device)  # [B, Support, slice_num, 1, 256, 256]
         s_y_fg = s_y_fg_orig.squeeze(2)  # [B, Support, 1, 256, 256]
         s_y_fg = s_y_fg.squeeze(2)  # [B, Support, 256, 256]
         s_y_bg = torch.ones_like(s_y_fg) - s_y_fg
-        q_x_orig = sample_test['q_x'].cuda()  # [B, slice_num, 1, 256, 256]
+        q_x_orig = sample_test['q_x'].to(device)  # [B, slice_num, 1, 256, 256]
         
 
         q_x = q_x_orig.squeeze(1)  # [B, 1, 256, 256]
-        q_y_orig = sample_test['q_y'].cuda()  # [B, slice_num, 1, 256, 256]
+        q_y_orig = sample_test['q_y'].to(device)  # [B, slice_num, 1, 256, 256]
         q_y = q_y_orig.squeeze(1)  # [B, 1, 256, 256]
         q_y = q_y.squeeze(1).long()  # [B, 256, 256]
         
@@ -245,11 +366,47 @@ def main(_run, _config, _log):
         s_y_bgs = [[s_y_bg[:, shot, ...] for shot in range(_config["n_shot"])]]
         q_xs = [q_x]
 
+        if equilibrium:
+            # the exact solve takes the same support cache or predict path as the prediction, so
+            # that both NFE count the same ODE states. It is left out of the latency.
+            model_orig.encoder.ode.ode.equilibrium = False
+            with torch.no_grad():
+                if support_cache:
+                    exact_yhat = model_orig.forward_support(encode_support(s_xs, sample_test['s_fname']),
+                                                            s_xs, s_y_fgs, s_y_bgs, q_xs)[0]
+                else:
+                    exact_yhat = model_orig.predict(s_x, s_y_fg, q_x)
+            model_orig.encoder.ode.ode.equilibrium = True
+            exact_preds[subj_idx].append(predict_labels(exact_yhat, q_y.shape[-2:])[:, None][batch_i].cpu().numpy())
+            exact_nfe.append(model_orig.encoder.ode.ode.stats.nfe_forward)
+
+        tic = time.perf_counter()
         with torch.no_grad():
-            q_yhat = model(s_xs, s_y_fgs, s_y_bgs, q_xs)[0]
+            if horizons:
+                horizon_outputs = model_orig.forward_horizons(s_xs, s_y_fgs, s_y_bgs, q_xs)
+                for h, outputs in enumerate(horizon_outputs):
+                    horizon_preds[h][subj_idx].append(predict_labels(outputs[0], q_y.shape[-2:])[:, None][batch_i].cpu().numpy())
+                q_yhat = horizon_outputs[-1][0]
+            elif support_cache:
+                supp_fts = encode_support(s_xs, sample_test['s_fname'])
+                q_yhat = model_orig.forward_support(supp_fts, s_xs, s_y_fgs, s_y_bgs, q_xs)[0]
+            else:
+                q_yhat = model_orig.predict(s_x, s_y_fg, q_x)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        latencies.append(time.perf_counter() - tic)
+        if _config["use_ode"]:
+            ode_stats = model_orig.encoder.ode.ode.stats.as_dict()
+            if model_orig.encoder.ode.ode.variance is not None:
+                ode_stats["feature_variance"] = model_orig.encoder.ode.ode.variance.mean().item()
+            for key, value in ode_stats.items():
+                _run.log_scalar(f'ode.{key}', value, i)
+                if _config['record']:
+                    writer.add_scalar(f'ode/{key}', value, i)
+            all_ode_stats.append(ode_stats)
         # q_yhat = q_yhat[:,1:2, ...]
         # all_prototypes.append(batch_prototypes)
-        q_yhat = q_yhat.argmax(dim=1)
+        q_yhat = predict_labels(q_yhat, q_y.shape[-2:])
         if not printed:
             print(q_yhat.shape)
             printed  = True
@@ -271,8 +428,12 @@ def main(_run, _config, _log):
     # print(all_prototypes.cpu().numpy().shape)
     # np.save("pnode_prototypes_fgsm.npy", all_prototypes.cpu().numpy())
 
+    if support_cache:
+        print(f"support cache: {len(support_fts)} slices encoded, {cache_hits} reused")
     print("start computing dice similarities ... total ", len(saves))
     dice_similarities = []
+    horizon_dices = [[] for _ in horizons]
+    exact_dices = []
     for subj_idx in range(len(saves)):
         imgs, preds, labels = [], [], []
         save_subj = saves[subj_idx]
@@ -297,6 +458,12 @@ def main(_run, _config, _log):
         # pdb.set_trace()
         dice = np.sum([label_arr * pred_arr]) * 2.0 / (np.sum(pred_arr) + np.sum(label_arr))
         dice_similarities.append(dice)
+        for h in range(len(horizons)):
+            horizon_arr = np.concatenate(horizon_preds[h][subj_idx], axis=0)
+            horizon_dices[h].append(np.sum(label_arr * horizon_arr) * 2.0 / (np.sum(horizon_arr) + np.sum(label_arr)))
+        if equilibrium:
+            exact_arr = np.concatenate(exact_preds[subj_idx], axis=0)
+            exact_dices.append(np.sum(label_arr * exact_arr) * 2.0 / (np.sum(exact_arr) + np.sum(label_arr)))
         # print(f"computing dice scores {subj_idx}/{10}", end='\n')
 
         if _config["save_vis"]:
@@ -369,11 +536,40 @@ def main(_run, _config, _log):
 
     print(f"test result \n n : {len(dice_similarities)}, mean dice score : \
     {np.mean(dice_similarities)} \n dice similarities : {dice_similarities}")
+    latency = 1000 * np.mean(latencies)
+    print(f"model latency per query slice : {latency:.1f} ms on {device.type}{' (int8)' if _config['int8'] else ''}")
+    _run.log_scalar('latency_ms', latency)
+    for ode_time, dices in zip(horizons, horizon_dices):
+        print(f"ode_time {ode_time} : mean dice score : {np.mean(dices):.4f}")
+        _run.log_scalar(f'dice_score.ode_time_{ode_time}', np.mean(dices))
+    if all_ode_stats:
+        nfe = np.array([stats["nfe_forward"] for stats in all_ode_stats])
+        wall_time = np.array([stats["wall_time"] for stats in all_ode_stats])
+        print(f"ode nfe per slice : mean {nfe.mean():.1f}, max {nfe.max()} | ode time per slice : mean {wall_time.mean():.4f}s, max {wall_time.max():.4f}s")
+        warm = np.array([stats["warm_start"] for stats in all_ode_stats], dtype=bool)
+        rejected = np.array([stats["rejected_steps"] for stats in all_ode_stats])
+        if warm.any() and (~warm).any():
+            print(f"ode rejected steps per slice : cold start {rejected[~warm].mean():.2f}, warm start {rejected[warm].mean():.2f}")
+    if equilibrium:
+        converged = np.array([stats["equilibrium"] for stats in all_ode_stats], dtype=bool)
+        nfe_saved = np.mean(exact_nfe) - nfe.mean()
+        dice_drift = np.mean(dice_similarities) - np.mean(exact_dices)
+        print(f"ode equilibrium : converged on {converged.mean() * 100:.1f}% of slices, nfe saved per slice {nfe_saved:.1f} "
+              f"(exact solve {np.mean(exact_nfe):.1f}) | dice drift {dice_drift:+.4f} (exact solve {np.mean(exact_dices):.4f})")
+        _run.log_scalar('ode.equilibrium_nfe_saved', nfe_saved)
+        _run.log_scalar('dice_score.equilibrium_drift', dice_drift)
     
 
     with open("test_results_adv_all.log", 'a') as f:
         f.write("\n" + _config["log_name"])
         f.write(" | Mean dice score : {:.4f}".format(np.mean(dice_similarities)))
+        f.write(" | Latency : {:.1f} ms ({}{})".format(latency, device.type, ", int8" if _config["int8"] else ""))
+        for ode_time, dices in zip(horizons, horizon_dices):
+            f.write(" | ode_time {} : {:.4f}".format(ode_time, np.mean(dices)))
+        if all_ode_stats:
+            f.write(" | Mean ode nfe : {:.1f}".format(np.mean([stats["nfe_forward"] for stats in all_ode_stats])))
+        if equilibrium:
+            f.write(" | Equilibrium nfe saved : {:.1f}, dice drift : {:+.4f}".format(nfe_saved, dice_drift))
         f.write("\n" + "="*60)
 
     if _config['record']:
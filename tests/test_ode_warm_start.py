@@ -0,0 +1,26 @@
+"""Warm start of the adaptive solves from the step cache of ODEBlock"""
+import pytest
+import torch
+
+from models.ode import ODEBlock, ODEfunc
+
+
+@pytest.mark.parametrize("per_sample", [False, True])
+def test_cached_step_adapts(per_sample):
+    torch.manual_seed(0)
+    solver = dict(method="dopri5", tol=1e-3, warm_start=True, per_sample=per_sample)
+    block = ODEBlock(ODEfunc(8, sigma=0), ode_time=1, solver=solver).eval()
+    x = torch.randn(2, 8, 8, 8)
+    key = (tuple(x.shape), False)
+    with torch.no_grad():
+        block(x)
+        cold = block.stats
+        block(x)
+        # a cautious first step is followed by a larger one
+        assert block.step_cache[key] > cold.first_step
+        assert block.stats.nfe_forward < cold.nfe_forward
+        block.step_cache[key] = 5.
+        block(x)
+        # an oversized step is rejected and the cache shrinks again
+        assert block.stats.rejected_steps > 0
+        assert block.step_cache[key] < 5.
@@ -1,4 +1,6 @@
 """Training Script"""
+import time
+START_TIME = time.perf_counter()
 import os
 import shutil
 import numpy as np
@@ -16,9 +18,9 @@ import torchvision.transforms as transforms
 from torchvision.utils import make_grid
 from tensorboardX import SummaryWriter
 from config import ex
-from util.utils import set_seed, CLASS_LABELS, date
+from util.utils import set_seed, peak_rss_mb, CLASS_LABELS, date
 from dataloaders_medical.prostate import *
-from models.fewshot import FewShotSeg
+from models.fewshot import FewShotSeg, predict_labels, soft_labels, soft_cross_entropy
 from models.ode import FewShotSegOde
 from tqdm import tqdm
 import torch.nn.functional as F
@@ -64,7 +66,7 @@ def main(_run, _config, _log):
 
     _log.info('###### Create model ######')
     if _config["use_ode"]:
-        model_orig = FewShotSegOde(pretrained_path=_config['path']['init_path'], pretrained_ode=_config["pretrain_ode"], ode_layers=_config["ode_layers"], ode_time=_config["ode_time"], noise_type=_config["feat_noise_type"], sigma=_config["gaussian_std"])
+        model_orig = FewShotSegOde(pretrained_path=_config['path']['init_path'], pretrained_ode=_config["pretrain_ode"], ode_layers=_config["ode_layers"], ode_time=_config["ode_time"], noise_type=_config["feat_noise_type"], sigma=_config["gaussian_std"], ode_solver=_config["ode_solver"], ode_backprop=_config["ode_backprop"], ode_script=_config["ode_script"], ode_conv=_config["ode_conv"], ode_conv_groups=_config["ode_conv_groups"], ode_conv_rank=_config["ode_conv_rank"], ode_pool=_config["ode_pool"], proto_pooling=_config["proto_pooling"], low_res_logits=_config["low_res_logits"], ode_reg=_config["ode_reg"])
     else:
         model_orig = FewShotSeg(pretrained_path=_config['path']['init_path'], cfg=_config['model'])
     model = nn.DataParallel(model_orig.cuda(), device_ids=[_config['gpu_id'],])
@@ -102,6 +104,10 @@ def main(_run, _config, _log):
         writer = SummaryWriter(f'board/train_{_config["board"]}_{date()}')
 
     log_loss = {'loss': 0}
+    startup_time, startup_rss = time.perf_counter() - START_TIME, peak_rss_mb()
+    _log.info(f'startup : {startup_time:.1f}s, peak RSS : {startup_rss:.0f} MB')
+    _run.log_scalar('startup.time', startup_time)
+    _run.log_scalar('startup.peak_rss_mb', startup_rss)
     _log.info('###### Training ######')
     total_iter = len(trainloader)
 
@@ -254,16 +260,8 @@ def main(_run, _config, _log):
         s_y_bgs = [[s_y_bg[:,shot, ...] for shot in range(_config["n_shot"])]]
         q_y = torch.cat(all_labels_q, 0)
         q_xs = all_samples_q
-        all_samples_fg  = []
-        all_samples_fg += s_y_fgs
-        for i in  range(_config["no_samples"]):
-            # if _config["n_shot"]  == 3:
-            #     all_samples_fg[0] += s_y_fgs[0]
-            # else:
-            all_samples_fg += s_y_fgs
-        if _config["input_noise_type"] == "augment_and_multiplicative":
-            for i in  range(_config["no_samples"]):
-                all_samples_fg += s_y_fgs
+        # every support copy, perturbed or clean, keeps the foreground masks of the episode
+        all_samples_fg = [s_y_fgs[0] for _ in all_samples_s]
         
         if not _config["use_cluster"]:
             all_samples_s = all_samples_s
@@ -272,7 +270,12 @@ def main(_run, _config, _log):
         # Forward and Backward
         optimizer.zero_grad()
         query_pred, _, all_fg_prototypes, query_feats = model(s_xs, s_y_fgs, s_y_bgs, q_xs, return_feats=True) #[B, 2, w, h]
-        query_loss = criterion(query_pred, q_y)
+        ode_stats = model_orig.encoder.ode.ode.stats if _config["use_ode"] else None
+        if _config["low_res_logits"]:
+            query_loss = soft_cross_entropy(query_pred, soft_labels(q_y, query_pred.shape[-2:], query_pred.shape[1],
+                                                                    ignore_index=_config['ignore_label']))
+        else:
+            query_loss = criterion(query_pred, q_y)
         if len(all_samples_fg) != 0:
             # for a in all_samples_s:
             #     print(a.shape)
@@ -304,7 +307,11 @@ def main(_run, _config, _log):
         if _config["cluster_weighting"]  == "linear":
             cl_weight *= (i_iter/total_iter) 
 
-        loss = query_loss + cl_weight * cluster_loss
+        ode_reg_loss, ode_reg_terms = 0, {}
+        if _config["use_ode"]:
+            ode_reg_loss, ode_reg_terms = model_orig.encoder.ode.ode.pop_regularisation()
+
+        loss = query_loss + cl_weight * cluster_loss + ode_reg_loss
         loss.backward()
         optimizer.step()
         scheduler.step()
@@ -313,6 +320,16 @@ def main(_run, _config, _log):
         query_loss = query_loss.detach().data.cpu().numpy()
         _run.log_scalar('loss', query_loss)
         log_loss['loss'] += query_loss
+        if ode_stats is not None:
+            for key, value in ode_stats.as_dict().items():
+                _run.log_scalar(f'ode.{key}', value)
+                if _config['record']:
+                    writer.add_scalar(f'ode/{key}', value, i_iter)
+        for key, value in ode_reg_terms.items():
+            ode_reg_terms[key] = value.item()
+            _run.log_scalar(f'ode.{key}', ode_reg_terms[key])
+            if _config['record']:
+                writer.add_scalar(f'ode/{key}', ode_reg_terms[key], i_iter)
 
         # print loss and take snapshots
         if (i_iter + 1) % _config['print_interval'] == 0:
@@ -321,12 +338,13 @@ def main(_run, _config, _log):
                 cl_loss = cl_weight*cluster_loss.detach().data.cpu().numpy() / (i_iter + 1)
             else:
                 cl_loss = "<not used>"
-            print(f'step {i_iter+1}/{total_iter}: loss: {loss}, cl_loss: {cl_loss}')
+            reg_log = "".join(f', {key}: {value:.4f}' for key, value in ode_reg_terms.items())
+            print(f'step {i_iter+1}/{total_iter}: loss: {loss}, cl_loss: {cl_loss}{reg_log}')
 
             if _config['record']:
                 batch_i = 0
                 frames = []
-                query_pred = query_pred.argmax(dim=1)
+                query_pred = predict_labels(query_pred, q_y.shape[-2:])
                 query_pred = query_pred.unsqueeze(1)
                 frames += overlay_color(q_x_orig[batch_i,0], query_pred[batch_i].float(), q_y_orig[batch_i,0])
                 visual = make_grid(frames, normalize=True, nrow=2)
@@ -1,5 +1,6 @@
 """Util functions"""
 import random
+import resource
 from datetime import datetime
 
 import torch
@@ -18,6 +19,12 @@ def date():
     string = now.strftime('%Y%m%d_%H%M%S')
     return string
 
+def peak_rss_mb():
+    """
+    Peak resident set size of the process in MB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
 def set_seed(seed):
     """
     Set the random seed